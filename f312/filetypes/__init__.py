@@ -5,4 +5,8 @@ Data representations.
 from .datafile import *
 from .filesqlitedb import *
 from .keystore import *
+from .keystore2 import *
+from .shardedkeystore import *
+from .asynckeystore import *
+from .valuecodecs import *
 from .filepy import *
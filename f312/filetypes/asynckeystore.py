@@ -0,0 +1,195 @@
+from .keystore import Keystore
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import queue
+import threading
+
+
+__all__ = ["AsyncKeystore"]
+
+
+class AsyncKeystore(object):
+    """asyncio interface to a Keystore file that does not block the event loop.
+
+    All writes go through a single writer thread that owns its own connection. Writes queued while
+    a transaction is being written are coalesced into the next transaction (up to max_batch
+    operations), so many concurrent writers cost a few commits. An awaited write returns once it
+    has been committed.
+
+    Reads are served by a pool of num_readers threads, each with its own connection. The database
+    is switched to WAL journal mode so that reads do not wait for the writer.
+
+    Usage:
+
+        async with AsyncKeystore("store.sqlite") as aks:
+            await aks.set("a", 1)
+            value = await aks.get("a")
+
+    Args:
+        filename: Keystore file
+        num_readers: number of read threads/connections
+        max_batch: maximum number of write operations per transaction
+        **kwargs: passed to the underlying Keystore objects (e.g. codec)
+    """
+
+    def __init__(self, filename, num_readers=4, max_batch=1000, **kwargs):
+        self.filename = filename
+        self.num_readers = num_readers
+        self.max_batch = max_batch
+        self.keystore_kwargs = kwargs
+        self.__queue = queue.Queue()
+        self.__writer = None
+        self.__readers = None
+        self.__local = threading.local()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def start(self):
+        """Starts the writer thread (which creates the file if needed) and the reader pool."""
+        if self.__writer is not None:
+            return
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        self.__writer = threading.Thread(target=self.__writer_main, args=(loop, ready),
+                                         name="AsyncKeystore-writer", daemon=True)
+        self.__writer.start()
+        try:
+            await ready
+        except BaseException:
+            self.__writer = None
+            raise
+        self.__readers = ThreadPoolExecutor(self.num_readers,
+                                            thread_name_prefix="AsyncKeystore-reader")
+
+    async def close(self):
+        """Waits for queued writes to be committed, then stops all threads."""
+        if self.__writer is None:
+            return
+        self.__queue.put(None)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.__writer.join)
+        self.__readers.shutdown(wait=True)
+        self.__writer, self.__readers = None, None
+
+    # # Reads
+    #   =====
+
+    async def get(self, key, default=None):
+        return await self.__read(lambda ks: ks.get(key, default))
+
+    async def get_many(self, keys):
+        keys = list(keys)
+        return await self.__read(lambda ks: ks.get_many(keys))
+
+    async def contains(self, key):
+        return await self.__read(lambda ks: key in ks)
+
+    # # Writes
+    #   ======
+
+    async def set(self, key, value):
+        await self.__write(lambda ks: ks.set_many(((key, value),)))
+        return value
+
+    async def set_many(self, items):
+        if hasattr(items, "items"):
+            items = items.items()
+        items = list(items)
+        return await self.__write(lambda ks: ks.set_many(items))
+
+    async def delete(self, key):
+        """Deletes key; raises KeyError if not found."""
+        def f(ks):
+            del ks[key]
+        await self.__write(f)
+
+    async def delete_many(self, keys):
+        keys = list(keys)
+        return await self.__write(lambda ks: ks.delete_many(keys))
+
+    # # Internal gear
+    #   =============
+
+    async def __read(self, f):
+        if self.__readers is None:
+            raise RuntimeError("AsyncKeystore not started")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__readers, self.__read_in_thread, f)
+
+    def __read_in_thread(self, f):
+        ks = getattr(self.__local, "ks", None)
+        if ks is None:
+            # No read cache: it would not see the writes made through the writer connection
+            ks = self.__local.ks = Keystore(self.filename, **dict(self.keystore_kwargs,
+                                                                  cache_entries=0))
+        return f(ks)
+
+    async def __write(self, f):
+        if self.__writer is None:
+            raise RuntimeError("AsyncKeystore not started")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__queue.put((f, loop, future))
+        return await future
+
+    def __writer_main(self, loop, ready):
+        try:
+            ks = Keystore(self.filename, **dict(self.keystore_kwargs, flag_auto_commit=False,
+                                                flag_write_behind=False))
+            ks.execute("pragma journal_mode=wal")
+        except BaseException as e:
+            loop.call_soon_threadsafe(_set_exception, ready, e)
+            return
+        loop.call_soon_threadsafe(_set_result, ready, None)
+
+        flag_stop = False
+        while not flag_stop:
+            batch = []
+            item = self.__queue.get()
+            while True:
+                if item is None:
+                    flag_stop = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    item = self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            results = []
+            conn = ks.get_conn()
+            try:
+                if not conn.in_transaction:
+                    ks.execute("begin immediate")
+                for f, loop_, future in batch:
+                    # A failing operation is undone alone, the rest of the batch is still committed
+                    try:
+                        with ks.savepoint():
+                            results.append((_set_result, loop_, future, f(ks)))
+                    except Exception as e:
+                        results.append((_set_exception, loop_, future, e))
+                ks.commit()
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                results = [(_set_exception, loop_, future, e) for _, loop_, future in batch]
+            for setter, loop_, future, x in results:
+                loop_.call_soon_threadsafe(setter, future, x)
+        ks.close_if_open()
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, e):
+    if not future.done():
+        future.set_exception(e)
@@ -2,7 +2,9 @@
 Ancestor class for all classes that represent an input file.
 """
 
+import mmap
 import os
+import shutil
 import a107
 
 
@@ -17,6 +19,23 @@ class DataFile(a107.AttrsPart):
                       (a) inherit _test_magic() (recommended);
                       (b) if there are no testable magic characters, test for absurd
                           within _do_load(). Try to crash early.
+
+    Binary formats (flag_txt False) may implement _do_load_buffer() instead of _do_load(): the
+    file is then memory-mapped and handed over as a read-only memoryview, so that e.g. NumPy
+    arrays can be built on it without copying (np.frombuffer()). The mapping stays open as long as
+    the object (or anything built on the buffer) is alive; see release_buffer().
+
+    Streaming: instead of _do_load()/_do_save_as(), subclasses may implement the generator hooks
+    _iter_load_chunks() and _iter_save_chunks(); the file is then read/written by this class
+    io_chunk_size characters/bytes at a time, so that files bigger than memory can be processed.
+
+    Atomic save (flag_atomic_save): save_as() writes into a temporary file in the destination
+    directory (same extension), flushes it to disk and then renames it over the destination, so
+    that the destination is never left half-written.
+
+    Lazy loading: load(filename, flag_lazy=True) only checks the file and calls
+    _do_load_header() (optional, for cheap header-only parsing); _do_load() is deferred until a
+    public attribute not set by _do_load_header() is accessed, or ensure_loaded() is called.
     """
     # Descendants shoulds set this
     default_filename = None
@@ -26,6 +45,10 @@ class DataFile(a107.AttrsPart):
     flag_collect = True
     # List of script names that can edit this file type
     editors = None
+    # Whether save_as() writes to a temporary file first and then renames it to the destination
+    flag_atomic_save = True
+    # Size of the chunks read/written by the streaming hooks
+    io_chunk_size = 1048576
 
 
     @a107.classproperty
@@ -36,8 +59,21 @@ class DataFile(a107.AttrsPart):
         a107.AttrsPart.__init__(self)
         # File name is set by load()
         self.__flag_loaded = False
+        # Lazy load pending: {"size": ..., "mtime": ..., "stash": {public attributes}}
+        self.__lazy = None
+        # Memory mapping of the file and memoryview given to _do_load_buffer()
+        self.__mmap = None
+        self.__buffer = None
         self.filename = None
 
+    def __getattr__(self, name):
+        # Called only when normal lookup fails: attributes hidden by a pending lazy load
+        if name.startswith("__") or self.__dict__.get("_DataFile__lazy") is None:
+            raise AttributeError("'{}' object has no attribute '{}'".format(
+                                 self.__class__.__name__, name))
+        self.ensure_loaded()
+        return getattr(self, name)
+
     # # Methods to be implemented by subclasses
     #   =======================================
 
@@ -48,6 +84,48 @@ class DataFile(a107.AttrsPart):
         raise NotImplementedError("Forgot to implement _do_load() for class '{}'".
                                   format(self.classname))
 
+    def _iter_load_chunks(self):
+        """
+        (optional) Generator that receives file contents in chunks, called instead of _do_load()
+
+        Receives each chunk (str if flag_txt, else bytes) through "yield"; an empty chunk means
+        end of file. May return early (e.g. when only the header is needed). Example:
+
+            def _iter_load_chunks(self):
+                while True:
+                    chunk = yield
+                    if not chunk:
+                        break
+                    ...
+        """
+        raise NotImplementedError()
+        yield
+
+    def _iter_save_chunks(self):
+        """
+        (optional) Generator of chunks to be written (str if flag_txt, else bytes), called instead
+        of _do_save_as()
+        """
+        raise NotImplementedError()
+        yield
+
+    def _do_load_buffer(self, buf):
+        """
+        (optional, binary formats) Loads file contents from read-only memoryview of the file
+
+        Called instead of _do_load() if implemented. Objects built on buf (e.g. NumPy arrays)
+        share memory with the mapped file; they must not be written to
+        """
+        raise NotImplementedError()
+
+    def _do_load_header(self, filename):
+        """
+        (optional) Loads only the part of the file that is cheap to parse (called by lazy load)
+
+        Attributes set here are available without triggering _do_load()
+        """
+        pass
+
     def _test_magic(self, filename):
         """
         Opens file just to verify whether it is what it is expected to be (**raise if not**)
@@ -74,11 +152,20 @@ class DataFile(a107.AttrsPart):
             filename = self.default_filename
         if filename is None:
             raise RuntimeError("Class '{}' has no default filename".format(self.__class__.__name__))
-        self._do_save_as(filename)
+        self.ensure_loaded()
+        if self.flag_atomic_save:
+            self.__save_atomic(filename)
+        else:
+            self.__do_save_as(filename)
         self.filename = filename
 
-    def load(self, filename=None):
-        """Loads file and registers filename as attribute."""
+    def load(self, filename=None, flag_lazy=False):
+        """Loads file and registers filename as attribute.
+
+        Args:
+            filename: defaults to self.default_filename
+            flag_lazy: defers _do_load() until first needed (see class docstring)
+        """
         assert not self.__flag_loaded, "File can be loaded only once"
         if filename is None:
             filename = self.default_filename
@@ -93,10 +180,84 @@ class DataFile(a107.AttrsPart):
             raise RuntimeError("Empty file: '{0!s}'".format(filename))
 
         self._test_magic(filename)
-        self._do_load(filename)
+        if flag_lazy:
+            stash = {name: value for name, value in self.__dict__.items()
+                     if not name.startswith("_") and name != "filename"}
+            for name in stash:
+                del self.__dict__[name]
+            stat = os.stat(filename)
+            self.__lazy = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "stash": stash}
+            self.filename = filename
+            self.__flag_loaded = True
+            self._do_load_header(filename)
+            return
+
+        self.__do_load(filename)
         self.filename = filename
         self.__flag_loaded = True
 
+    def release_buffer(self):
+        """Drops this object's hold on the file mapping used by _do_load_buffer().
+
+        The file is unmapped right away if nothing built on the buffer is alive any more;
+        otherwise, when the last such object is gone.
+        """
+        buf, mm = self.__buffer, self.__mmap
+        self.__buffer, self.__mmap = None, None
+        if buf is None:
+            return
+        try:
+            buf.release()
+            mm.close()
+        except BufferError:
+            # Still exported (e.g. to a NumPy array)
+            pass
+
+    @property
+    def flag_lazy_pending(self):
+        """Whether a lazy load is waiting for _do_load()"""
+        return self.__lazy is not None
+
+    def ensure_loaded(self):
+        """Completes pending lazy load, if any.
+
+        Raises RuntimeError if the file changed (size or modification time) since load()
+        """
+        lazy = self.__lazy
+        if lazy is None:
+            return
+        stat = os.stat(self.filename)
+        if stat.st_size != lazy["size"] or stat.st_mtime_ns != lazy["mtime"]:
+            raise RuntimeError("File '{}' changed since it was lazily loaded".format(self.filename))
+        self.__lazy = None
+        for name, value in lazy["stash"].items():
+            self.__dict__.setdefault(name, value)
+        try:
+            self.__do_load(self.filename)
+        except BaseException:
+            self.__lazy = lazy
+            raise
+
+    # # Internal gear
+    #   =============
+
+    def __do_load(self, filename):
+        if self.flag_txt or type(self)._do_load_buffer is DataFile._do_load_buffer:
+            if type(self)._iter_load_chunks is DataFile._iter_load_chunks:
+                self._do_load(filename)
+            else:
+                self.__load_chunks(filename)
+            return
+        with open(filename, "rb") as file:
+            mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.release_buffer()
+        self.__mmap, self.__buffer = mm, memoryview(mm)
+        try:
+            self._do_load_buffer(self.__buffer)
+        except BaseException:
+            self.release_buffer()
+            raise
+
     def init_default(self):
         """
         Initializes object with its default values
@@ -113,4 +274,61 @@ class DataFile(a107.AttrsPart):
         self.filename = None
 
     def validate(self):
-        pass
\ No newline at end of file
+        pass
+
+    def __load_chunks(self, filename):
+        consumer = self._iter_load_chunks()
+        try:
+            next(consumer)
+            # Binary: unbuffered, each chunk is read straight from the file
+            with open(filename, "r") if self.flag_txt else open(filename, "rb", buffering=0) \
+                    as file:
+                while True:
+                    chunk = file.read(self.io_chunk_size)
+                    consumer.send(chunk)
+                    if not chunk:
+                        break
+        except StopIteration:
+            return
+        consumer.close()
+
+    def __do_save_as(self, filename):
+        if type(self)._iter_save_chunks is DataFile._iter_save_chunks:
+            self._do_save_as(filename)
+            return
+        with open(filename, "w" if self.flag_txt else "wb", buffering=self.io_chunk_size) as file:
+            for chunk in self._iter_save_chunks():
+                file.write(chunk)
+
+    def __save_atomic(self, filename):
+        dirname, basename = os.path.split(os.path.abspath(filename))
+        tmpname = os.path.join(dirname, ".~{}-{}".format(os.urandom(4).hex(), basename))
+        try:
+            self.__do_save_as(tmpname)
+            fd = os.open(tmpname, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if os.path.exists(filename):
+                shutil.copymode(filename, tmpname)
+            os.replace(tmpname, filename)
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        _fsync_dir(dirname)
+
+
+def _fsync_dir(dirname):
+    """Makes a rename in dirname durable (POSIX; no-op where directories cannot be opened)"""
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
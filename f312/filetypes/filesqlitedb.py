@@ -1,24 +1,174 @@
 import shutil
 import os
-from collections import OrderedDict
+import atexit
+import csv
+from collections import OrderedDict, deque
+import contextlib
+import queue
 import sqlite3
+import threading
+import time
+import itertools
+import random
+import urllib.parse
+import uuid
+import weakref
 import a107
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
-__all__ = ["FileSQLiteDB", "get_table_info"]
+__all__ = ["FileSQLiteDB", "get_table_info", "PRAGMA_PROFILES"]
+
+
+# Named sets of PRAGMA settings applied to every new connection (see FileSQLiteDB)
+#
+# - "durable": SQLite defaults made explicit: rollback journal, full fsync on every commit
+# - "fast-wal": WAL journal (readers do not block the writer), fsync only at checkpoints
+#   (committed transactions may be lost on power failure, but the file is never corrupted),
+#   larger page cache, memory-mapped I/O
+# - "bulk-load": for filling a database from scratch; no fsync at all (**a crash may corrupt
+#   the file**), big page cache
+PRAGMA_PROFILES = {
+    "durable": OrderedDict((("journal_mode", "delete"), ("synchronous", "full"),
+                            ("cache_size", -2000), ("mmap_size", 0),
+                            ("temp_store", "default"), ("busy_timeout", 5000))),
+    "fast-wal": OrderedDict((("journal_mode", "wal"), ("synchronous", "normal"),
+                             ("cache_size", -65536), ("mmap_size", 268435456),
+                             ("temp_store", "memory"), ("busy_timeout", 5000))),
+    "bulk-load": OrderedDict((("journal_mode", "wal"), ("synchronous", "off"),
+                              ("cache_size", -262144), ("mmap_size", 268435456),
+                              ("temp_store", "memory"), ("busy_timeout", 5000))),
+}
+
+# Databases in in-memory mode, to be snapshotted at interpreter exit
+_in_memory_dbs = weakref.WeakSet()
 
 
 class FileSQLiteDB(object):
     """Represents a SQLite database file.
 
     This class is not supposed to be instantialized. It serves as an ancestor for other classes
-    that implement specific database schemas."""
+    that implement specific database schemas.
+
+    Connection settings: PRAGMA statements are applied to every new connection according to
+    the pragma_profile (name of a PRAGMA_PROFILES entry; subclasses may set the class attribute)
+    and the individual settings in pragmas, which take precedence. get_pragmas() reads the
+    settings back from the database.
+
+    Args:
+        filename: database file
+        flag_thread_local: each thread gets its own connection (by default, a single connection
+                           is used, which can only be used by the thread that created it).
+                           close_if_open() closes the connections of all threads
+        read_pool_size: maximum number of connections in the read connection pool (see
+                        read_conn()). Read connections are opened lazily, are query-only, and are
+                        closed by close_if_open(). Pairs well with WAL journal mode, in which
+                        readers do not block nor get blocked by the writer
+        pragma_profile: overrides class attribute pragma_profile
+        pragmas: {pragma name: value, ...} (optional)
+        flag_read_only: opens the file in read-only mode ("file:...?mode=ro" URI). The file must
+                        exist; the schema is not checked/created, and write methods raise
+                        RuntimeError right away
+        flag_immutable: (implies flag_read_only) tells SQLite that the file cannot change while
+                        open ("immutable=1"): no locking and no journal checks at all. **Only**
+                        for files that nobody writes to
+        flag_shared_cache: (read-only mode) connections of this process share the page cache
+        busy_timeout: (milliseconds) how long SQLite waits for a lock held by another connection
+                      before failing with "database is locked" (sets PRAGMA busy_timeout)
+        max_retries: number of times a statement, BEGIN IMMEDIATE or COMMIT is retried after
+                     failing with "database is locked/busy". Statements are only retried when no
+                     transaction is open (inside a transaction, the whole transaction would have
+                     to be retried). See get_lock_stats()
+        retry_delay: (seconds) maximum wait before the first retry; doubles at every retry, up to
+                     retry_max_delay. Actual waits are randomized ("jitter") so that competing
+                     processes do not retry in lockstep
+        retry_max_delay: (seconds)
+        flag_in_memory: the database lives in memory (SQLite "memdb" VFS, shared by all
+                        connections of this object); the file is only read when the first
+                        connection is opened (through the backup API) and written by snapshot().
+                        Snapshots are also taken every snapshot_interval seconds and/or
+                        snapshot_writes changed rows, and by close_if_open() and at interpreter
+                        exit. Changes made after the last snapshot are lost on a crash. The file
+                        must not be used by anyone else meanwhile; if it is in WAL mode, it is
+                        switched back to rollback-journal mode when loaded. Requires SQLite 3.36
+                        or later
+        snapshot_interval: (seconds, in-memory mode) snapshots from a background thread if rows
+                           changed since the last snapshot
+        snapshot_writes: (in-memory mode) snapshots at commit() once this many rows have changed
+                         since the last snapshot
 
-    def __init__(self, filename):
+    Multi-process writers: besides busy_timeout/retries, use transaction(flag_immediate=True) for
+    transactions that read before writing: "BEGIN IMMEDIATE" takes the write lock upfront,
+    avoiding lock-upgrade deadlocks (which SQLite reports right away, without waiting).
+    """
+
+    # Name of PRAGMA_PROFILES entry applied to new connections (None: no PRAGMAs are set)
+    pragma_profile = None
+
+    def __init__(self, filename, flag_thread_local=False, read_pool_size=4, pragma_profile=None,
+                 pragmas=None, flag_read_only=False, flag_immutable=False,
+                 flag_shared_cache=False, busy_timeout=None, max_retries=5, retry_delay=0.01,
+                 retry_max_delay=1., flag_in_memory=False, snapshot_interval=None,
+                 snapshot_writes=None):
         self.__conn = None
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.__lock_stats = _new_lock_stats()
+        self.flag_read_only = flag_read_only or flag_immutable
+        self.flag_immutable = flag_immutable
+        self.flag_shared_cache = flag_shared_cache
+        if pragma_profile is not None:
+            self.pragma_profile = pragma_profile
+        if self.pragma_profile is not None and self.pragma_profile not in PRAGMA_PROFILES:
+            raise ValueError("Invalid PRAGMA profile: '{}' (valid: {})".format(
+                             self.pragma_profile, ", ".join(PRAGMA_PROFILES)))
+        # {pragma name: value, ...} applied to every new connection
+        self.pragmas = OrderedDict(PRAGMA_PROFILES.get(self.pragma_profile, ()))
+        if pragmas is not None:
+            self.pragmas.update(pragmas)
+        if busy_timeout is not None:
+            self.pragmas["busy_timeout"] = busy_timeout
+        self.flag_thread_local = flag_thread_local
+        self.read_pool_size = read_pool_size
+        # Thread-local mode: per-thread connections; generation is incremented by
+        # close_if_open() to invalidate the connections of all threads
+        self.__local = threading.local()
+        self.__generation = 0
+        # _ThreadConn of every thread; entries go away (closing their connections) as threads end
+        self.__thread_conns = weakref.WeakSet()
+        self.__lock = threading.Lock()
+        # Read pool: idle connections and all connections handed out
+        self.__pool_idle = queue.LifoQueue()
+        self.__pool_conns = []
+        # Query instrumentation (None: disabled)
+        self.__stats = None
+        # Schema introspection results, valid while "pragma schema_version" does not change
+        self.__schema_cache = {}
+        if flag_in_memory and self.flag_read_only:
+            raise ValueError("flag_in_memory cannot be combined with read-only mode")
+        self.flag_in_memory = flag_in_memory
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_writes = snapshot_writes
+        # In-memory mode: connection keeping the memory database alive (None: not loaded), number
+        # of rows changed since last snapshot, and last total_changes seen per connection
+        self.__memory_uri = "file:/f312-{}?vfs=memdb".format(uuid.uuid4().hex)
+        self.__memory = None
+        self.__memory_lock = threading.RLock()
+        self.__unsaved_writes = 0
+        self.__total_changes = {}
+        self.__snapshot_thread = None
+        self.__snapshot_stop = threading.Event()
 
         self.filename = filename
-        self.ensure_schema()
+        if self.flag_read_only:
+            if not os.path.isfile(filename):
+                raise RuntimeError("File not found: '{}' (read-only mode)".format(filename))
+        else:
+            self.ensure_schema()
 
     # # You should override this
     #   ========================
@@ -41,7 +191,71 @@ class FileSQLiteDB(object):
             cursor
         """
         conn = self.__get_conn()
-        return conn.execute(*args, **kwargs)
+        if self.max_retries and not conn.in_transaction:
+            return self.__retry_on_lock(self.__execute, conn, conn.execute, args, kwargs)
+        return self.__execute(conn, conn.execute, args, kwargs)
+
+    def executemany(self, *args, **kwargs):
+        """Executes a query against a sequence of parameters; wraps connection.executemany().
+
+        Returns:
+            cursor
+        """
+        conn = self.__get_conn()
+        if self.max_retries and not conn.in_transaction:
+            return self.__retry_on_lock(self.__execute, conn, conn.executemany, args, kwargs)
+        return self.__execute(conn, conn.executemany, args, kwargs)
+
+    def get_lock_stats(self):
+        """Returns lock contention counters.
+
+        Returns:
+            {"lock_errors": number of "database is locked/busy" errors (after busy_timeout),
+             "retries": number of retries,
+             "failures": number of operations that failed after max_retries,
+             "wait_time": total time (seconds) slept between retries}
+        """
+        return dict(self.__lock_stats)
+
+    def reset_lock_stats(self):
+        self.__lock_stats = _new_lock_stats()
+
+    # # Instrumentation
+    #   ===============
+
+    def enable_instrumentation(self, slow_threshold=None, slow_callback=None, max_samples=1000):
+        """Starts recording statistics for the statements run through execute()/executemany().
+
+        Per distinct SQL statement, records: number of executions, total/percentile latency of
+        the execute call, and number of rows fetched from the returned cursors.
+
+        Args:
+            slow_threshold: (seconds) statements taking at least this long are logged (see
+                            get_slow_queries()) together with their "EXPLAIN QUERY PLAN"
+            slow_callback: callable(sql, elapsed, plan) called for every slow statement; plan is a
+                           list of strings
+            max_samples: number of most recent latencies kept per statement for the percentiles
+        """
+        self.__stats = _QueryStats(slow_threshold, slow_callback, max_samples)
+
+    def disable_instrumentation(self):
+        """Stops recording; statistics are discarded. Disabled, execute() has negligible overhead
+        """
+        self.__stats = None
+
+    def get_query_stats(self):
+        """Returns {sql: {"count": ..., "total": ..., "mean": ..., "p50": ..., "p95": ...,
+        "p99": ..., "max": ..., "rows": ...}, ...} (times in seconds), or None if disabled.
+        """
+        return None if self.__stats is None else self.__stats.get_stats()
+
+    def get_slow_queries(self):
+        """Returns list of recent slow statements as dicts with keys "sql", "elapsed", "plan"."""
+        return [] if self.__stats is None else list(self.__stats.slow_queries)
+
+    def reset_query_stats(self):
+        if self.__stats is not None:
+            self.__stats.reset()
 
     def test(self, filename):
         """Tries to run harmless SQL statement thereby checking if the database is sane."""
@@ -52,6 +266,9 @@ class FileSQLiteDB(object):
         """Closes connection, copies DB file, and opens again pointing to new file.
 
         **Note** if filename equals current filename, does nothing!
+
+        **Note** blocks all users of the file during the copy; see backup() and vacuum_into() for
+                 snapshots taken while the database stays in use
         """
         if filename != self.filename:
             self.__ensure_filename()
@@ -59,31 +276,181 @@ class FileSQLiteDB(object):
             shutil.copyfile(self.filename, filename)
             self.__get_conn(filename=filename)
 
+    def backup(self, filename, pages=1024, sleep=0.001, progress=None):
+        """Online snapshot of the database into filename using the SQLite backup API.
+
+        The connection stays open and the database remains usable while the copy proceeds, pages
+        at a time. The result is a consistent copy of the database, also in WAL mode. Must be
+        called with no transaction open on this object's connection.
+
+        Args:
+            filename: destination file (overwritten if it exists)
+            pages: number of pages copied per step (0 or negative: all pages in one step)
+            sleep: seconds to sleep between steps, letting other connections use the database
+            progress: callable(remaining, total) called after each step (counts in pages)
+        """
+        self.__ensure_filename()
+        if os.path.abspath(filename) == os.path.abspath(self.filename):
+            raise ValueError("Cannot back up database onto itself")
+        conn = self.__get_conn()
+        if conn.in_transaction:
+            # The backup would wait forever for the lock held by this very connection
+            raise RuntimeError("Cannot back up database while a transaction is open "
+                               "(call commit() first)")
+        dest = sqlite3.connect(filename)
+        try:
+            conn.backup(dest, pages=pages, sleep=sleep,
+                        progress=None if progress is None else
+                        lambda status, remaining, total: progress(remaining, total))
+        finally:
+            dest.close()
+
+    def vacuum_into(self, filename):
+        """Writes a compacted copy of the database into filename (SQL "VACUUM INTO").
+
+        Unlike backup(), free pages are not copied and the copy is defragmented. Runs in a single
+        step (holding a read transaction on the database) and cannot be called within an open
+        transaction. Requires SQLite 3.27 or later.
+
+        Args:
+            filename: destination file. **Must not exist**
+        """
+        self.__ensure_filename()
+        if os.path.exists(filename):
+            raise RuntimeError("File already exists: '{}'".format(filename))
+        self.__get_conn().execute("vacuum into ?", (filename,))
+
     def commit(self):
-        self.get_conn().commit()
+        """Commits current transaction.
+
+        **Note** inside a transaction() block, does nothing: the block commits when it exits
+        """
+        if getattr(self.__local, "tx_depth", 0) > 0:
+            return
+        conn = self.get_conn()
+        self.__retry_on_lock(conn.commit)
+        if self.flag_in_memory:
+            self.__count_writes(conn)
+
+    def snapshot(self):
+        """(in-memory mode) Writes the database to the file now.
+
+        The copy goes to a temporary file that then replaces the file, so the file is always
+        either the previous or the new snapshot.
+        """
+        if not self.flag_in_memory:
+            raise RuntimeError("snapshot() is only available in in-memory mode")
+        self.__ensure_filename()
+        with self.__memory_lock:
+            if self.__memory is None:
+                return
+            # Rows changed during the backup count towards the next snapshot
+            n, self.__unsaved_writes = self.__unsaved_writes, 0
+            tmpname = self.filename+"-snapshot"
+            try:
+                dest = sqlite3.connect(tmpname)
+                try:
+                    self.__memory.backup(dest)
+                finally:
+                    dest.close()
+                os.replace(tmpname, self.filename)
+            except BaseException:
+                self.__unsaved_writes += n
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+                raise
+
+    @contextlib.contextmanager
+    def transaction(self, flag_immediate=False):
+        """Context manager that runs a block of statements in a single transaction.
+
+        Commits when the block exits normally, rolls back if it raises. commit() calls inside the
+        block (including the ones made by subclasses, e.g. Keystore with flag_auto_commit) are
+        deferred to the end of the block. If a transaction is already open, works as savepoint().
+
+        Args:
+            flag_immediate: issues "BEGIN IMMEDIATE", i.e., takes the write lock right away
+
+        Usage:
+
+            with db.transaction():
+                db.execute("insert ...")
+                db.execute("update ...")
+        """
+        conn = self.get_conn()
+        if conn.in_transaction:
+            with self.savepoint():
+                yield conn
+            return
+        self.__retry_on_lock(conn.execute, "begin immediate" if flag_immediate else "begin")
+        self.__local.tx_depth = 1
+        try:
+            yield conn
+        except BaseException:
+            self.__local.tx_depth = 0
+            conn.rollback()
+            raise
+        self.__local.tx_depth = 0
+        try:
+            self.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    @contextlib.contextmanager
+    def savepoint(self):
+        """Context manager for a nested transaction (SQL SAVEPOINT).
+
+        On normal exit, the savepoint is released (its changes become part of the enclosing
+        transaction); if the block raises, only the changes made within the block are rolled back.
+        If no transaction is open, works as transaction().
+        """
+        conn = self.get_conn()
+        if not conn.in_transaction:
+            with self.transaction():
+                yield conn
+            return
+        depth = getattr(self.__local, "tx_depth", 0)
+        name = "sp{}".format(depth)
+        conn.execute("savepoint {}".format(name))
+        self.__local.tx_depth = depth+1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("rollback to {}".format(name))
+            conn.execute("release {}".format(name))
+            raise
+        finally:
+            self.__local.tx_depth = depth
+        conn.execute("release {}".format(name))
 
     def ensure_schema(self):
         """Create file and schema if it does not exist yet."""
         self.__ensure_filename()
         if not os.path.isfile(self.filename):
             self.create_schema()
+            if self.flag_in_memory:
+                self.snapshot()
 
     def close_if_open(self):
         return self.__close_if_open()
 
     def delete(self):
         """Removes .sqlite file. **CAREFUL** needless say"""
+        self._check_writable()
         self.__ensure_filename()
         self.__close_if_open()
         os.remove(self.filename)
 
     def create_schema(self):
         """Creates database schema"""
+        self._check_writable()
         self.__ensure_filename()
         self.__create_schema()
 
     def populate(self):
         """Series of INSERT statements to populate database with its initial contents"""
+        self._check_writable()
         self.__ensure_filename()
         self._populate()
 
@@ -99,6 +466,250 @@ class FileSQLiteDB(object):
         self.__ensure_filename()
         return self.__get_conn(flag_force_new)
 
+    @contextlib.contextmanager
+    def read_conn(self, timeout=None):
+        """Context manager that checks out a connection from the read pool and checks it back in.
+
+        Usage:
+
+            with db.read_conn() as conn:
+                rows = conn.execute("select ...").fetchall()
+        """
+        conn = self.checkout_read_conn(timeout)
+        try:
+            yield conn
+        finally:
+            self.checkin_read_conn(conn)
+
+    def checkout_read_conn(self, timeout=None):
+        """Takes a (query-only) connection from the read pool.
+
+        Opens a new connection if none is idle and the pool has less than read_pool_size
+        connections; otherwise waits until a connection is checked in.
+
+        Args:
+            timeout: maximum time to wait (seconds); None means forever
+        """
+        self.__ensure_filename()
+        try:
+            return self.__pool_idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.__lock:
+            if len(self.__pool_conns) < self.read_pool_size:
+                conn = self.__get_conn_really(self.filename, check_same_thread=False)
+                conn.execute("pragma query_only = 1")
+                self.__pool_conns.append(conn)
+                return conn
+        try:
+            return self.__pool_idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError("Timeout waiting for a read connection ({} connections in use)".
+                               format(self.read_pool_size))
+
+    def checkin_read_conn(self, conn):
+        """Returns connection taken by checkout_read_conn() to the pool."""
+        with self.__lock:
+            flag_pooled = any(conn is x for x in self.__pool_conns)
+        if flag_pooled:
+            self.__pool_idle.put(conn)
+        else:
+            # Pool was closed while connection was checked out
+            conn.close()
+
+    # # Bulk reading
+    #   ============
+
+    def iter_rows(self, sql, params=(), chunk_size=1000, row_factory=sqlite3.Row):
+        """Generates result rows of a query, fetching chunk_size rows at a time.
+
+        Args:
+            sql, params: query and its parameters
+            chunk_size: number of rows per fetchmany() call
+            row_factory: sqlite3 row factory; None gives plain tuples, which are cheaper to build
+                         than sqlite3.Row objects
+        """
+        cursor = self.execute(sql, params)
+        cursor.row_factory = row_factory
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+
+    def fetch_columns(self, sql, params=(), dtypes=None, flag_structured=False):
+        """Runs query and returns the result as NumPy arrays, one per column. Requires NumPy.
+
+        Rows go from the cursor straight into a NumPy structured array as tuples, without
+        sqlite3.Row objects or intermediate lists.
+
+        Column types are inferred from all rows: integers --> int64; numbers with at least one
+        float or NULL --> float64 (NULL becomes nan); anything else --> object. Rows are converted
+        in chunks; if a chunk does not fit the types inferred so far, the columns are upcast.
+
+        Args:
+            sql, params: query and its parameters
+            dtypes: {column name: NumPy dtype, ...} overriding inferred types
+            flag_structured: returns the structured array instead of a dict of arrays
+
+        Returns:
+            {column name: array, ...} or structured array
+        """
+        if np is None:
+            raise RuntimeError("fetch_columns() requires NumPy")
+        cursor = self.execute(sql, params)
+        cursor.row_factory = None
+        names = [d[0] for d in cursor.description]
+        dtypes = dtypes or {}
+        column_dtypes = [dtypes.get(name) for name in names]
+        parts = []
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for i, name in enumerate(names):
+                if name not in dtypes:
+                    column_dtypes[i] = _widen_dtype(column_dtypes[i], _infer_dtype(rows, i))
+            parts.append(np.fromiter(rows, dtype=list(zip(names, column_dtypes)),
+                                     count=len(rows)))
+        dtype = np.dtype([(name, np.float64 if column_dtype is None else column_dtype)
+                          for name, column_dtype in zip(names, column_dtypes)])
+        if not parts:
+            ret = np.empty(0, dtype=dtype)
+        elif len(parts) == 1:
+            ret = parts[0]
+        else:
+            ret = np.concatenate([part.astype(dtype) for part in parts])
+        if flag_structured:
+            return ret
+        return OrderedDict((name, ret[name]) for name in names)
+
+    # # Bulk import/export
+    #   ==================
+
+    def bulk_insert(self, table, rows, columns=None, chunk_size=10000, flag_rebuild_indexes=False,
+                    flag_bulk_pragmas=False):
+        """Inserts many rows into table using executemany() in chunks, in a single transaction.
+
+        Args:
+            table: table name
+            rows: one of:
+                  - iterable of sequences (tuples, lists, ...)
+                  - name of a CSV file. If columns is not passed, its first line is taken as the
+                    column names
+                  - NumPy structured array (columns default to its field names) or 2D array
+            columns: list of column names (defaults to all columns of the table)
+            chunk_size: number of rows per executemany() call
+            flag_rebuild_indexes: drops the secondary indexes of table before inserting and
+                                  creates them again afterwards (faster for large loads)
+            flag_bulk_pragmas: applies the cache_size/temp_store settings of the "bulk-load"
+                               PRAGMA profile during the load and, in WAL journal mode only,
+                               "synchronous = off". **Risk**: with synchronous off, a power loss
+                               or OS crash while the load commits may lose the load (in WAL mode,
+                               the rest of the file is safe; in rollback-journal mode it could
+                               corrupt the whole file, which is why it is not applied there)
+
+        Returns:
+            {"rows": ..., "elapsed": ..., "rows_per_second": ...}
+        """
+        self._check_writable()
+        t = time.perf_counter()
+        file = None
+        n = 0
+        try:
+            if isinstance(rows, str):
+                filename = rows
+                file = open(filename, "r", newline="")
+                rows = csv.reader(file)
+                if columns is None:
+                    columns = next(rows, None)
+                    if columns is None:
+                        raise RuntimeError("CSV file '{}' is empty (expected a header line with "
+                                           "the column names)".format(filename))
+            elif np is not None and isinstance(rows, np.ndarray):
+                if columns is None and rows.dtype.names is not None:
+                    columns = list(rows.dtype.names)
+                rows = _iter_array_rows(rows, chunk_size)
+            if columns is None:
+                columns = self.get_column_names(table)
+            sql = "insert into {} ({}) values ({})".format(
+                  _quote(table), ", ".join(_quote(c) for c in columns),
+                  ", ".join("?"*len(columns)))
+
+            with self.__bulk_pragmas(flag_bulk_pragmas), self.transaction():
+                indexes = self.__drop_indexes(table) if flag_rebuild_indexes else []
+                it = iter(rows)
+                while True:
+                    chunk = list(itertools.islice(it, chunk_size))
+                    if not chunk:
+                        break
+                    self.executemany(sql, chunk)
+                    n += len(chunk)
+                for index_sql in indexes:
+                    self.execute(index_sql)
+        finally:
+            if file is not None:
+                file.close()
+        return _bulk_stats(n, time.perf_counter()-t)
+
+    def bulk_export(self, table, sink, columns=None, chunk_size=10000):
+        """Streams all rows of table into sink, chunk_size rows at a time.
+
+        Args:
+            table: table name
+            sink: one of:
+                  - name of a CSV file to be written (first line has the column names)
+                  - object with a writerows() method, e.g. a csv.writer
+                  - callable, called with each chunk (list of tuples)
+            columns: list of column names (defaults to all columns of the table)
+            chunk_size: number of rows fetched at a time
+
+        Returns:
+            {"rows": ..., "elapsed": ..., "rows_per_second": ...}
+        """
+        t = time.perf_counter()
+        if columns is None:
+            columns = self.get_column_names(table)
+        sql = "select {} from {}".format(", ".join(_quote(c) for c in columns), _quote(table))
+        file = None
+        if isinstance(sink, str):
+            file = open(sink, "w", newline="")
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            sink = writer.writerows
+        elif hasattr(sink, "writerows"):
+            sink = sink.writerows
+        n = 0
+        try:
+            cursor = self.execute(sql)
+            cursor.row_factory = None
+            while True:
+                chunk = cursor.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                sink(chunk)
+                n += len(chunk)
+        finally:
+            if file is not None:
+                file.close()
+        return _bulk_stats(n, time.perf_counter()-t)
+
+    def get_pragmas(self, names=None):
+        """Returns current values of PRAGMA settings as read from the connection.
+
+        Args:
+            names: list of pragma names. Defaults to the names in self.pragmas, or those of
+                   the "durable" profile if self.pragmas is empty
+
+        Returns:
+            {pragma name: value, ...}
+        """
+        if names is None:
+            names = list(self.pragmas) or list(PRAGMA_PROFILES["durable"])
+        conn = self.__get_conn()
+        return OrderedDict((name, conn.execute("pragma {}".format(name)).fetchone()[0])
+                           for name in names)
+
     def get_column_names(self, tablename):
         info = self.get_table_info(tablename)
         return list(info.keys())
@@ -106,11 +717,13 @@ class FileSQLiteDB(object):
     def get_table_info(self, tablename):
         """Returns information about fields of a specific table
 
+        Results are cached until the database schema changes.
+
         Returns:  {"fieldname": row, ...}
         """
         conn = self.__get_conn()
 
-        return get_table_info(conn, tablename)
+        ret = self.__retry_on_lock(get_table_info, conn, tablename, self.__schema_cache)
 
         if len(ret) == 0:
             raise RuntimeError("Cannot get info for table '{}'".format(tablename))
@@ -118,31 +731,118 @@ class FileSQLiteDB(object):
         return ret
 
     def get_table_names(self):
+        """Returns list of table names. Results are cached until the database schema changes."""
         # http://stackoverflow.com/questions/305378/list-of-tables-db-schema-dump-etc-using-the-python-sqlite3-api
 
         conn = self.__get_conn()
 
-        return self.__get_table_names(conn)
+        def f():
+            cache = _validate_schema_cache(conn, self.__schema_cache)
+            names = cache.get(("tables",))
+            if names is None:
+                names = cache[("tables",)] = self.__get_table_names(conn)
+            return list(names)
+
+        return self.__retry_on_lock(f)
+
+    # # Protected
+    #   =========
+
+    def _check_writable(self):
+        """Raises RuntimeError if database was opened read-only. Call this before writing"""
+        if self.flag_read_only:
+            raise RuntimeError("Database '{}' is open in read-only mode".format(self.filename))
 
     # # Internal gear
     #   =============
 
+    def __execute(self, conn, method, args, kwargs):
+        if self.__stats is None:
+            return method(*args, **kwargs)
+        return self.__stats.run(conn, method, args, kwargs)
+
+    def __retry_on_lock(self, f, *args):
+        """Calls f(*args), retrying with jittered exponential backoff on lock errors"""
+        delay = self.retry_delay
+        attempt = 0
+        while True:
+            try:
+                return f(*args)
+            except sqlite3.OperationalError as e:
+                if not _is_lock_error(e):
+                    raise
+                self.__lock_stats["lock_errors"] += 1
+                if attempt >= self.max_retries:
+                    self.__lock_stats["failures"] += 1
+                    raise
+            wait = random.uniform(delay/2, delay)
+            self.__lock_stats["retries"] += 1
+            self.__lock_stats["wait_time"] += wait
+            time.sleep(wait)
+            delay = min(delay*2, self.retry_max_delay)
+            attempt += 1
+
     def __get_table_names(self, conn):
         # Note: passing conn as argument is needed to avoid cyclic recursion, because
         r = conn.execute("select name from sqlite_master where type = 'table'")
         names = [row["name"] for row in r]
         return names
 
+    @contextlib.contextmanager
+    def __bulk_pragmas(self, flag):
+        """Temporarily applies settings of the "bulk-load" profile (except journal_mode)."""
+        if not flag:
+            yield
+            return
+        names = ["cache_size", "temp_store"]
+        if self.get_pragmas(["journal_mode"])["journal_mode"] == "wal":
+            names.append("synchronous")
+        settings = OrderedDict((name, value) for name, value in PRAGMA_PROFILES["bulk-load"].items()
+                               if name in names)
+        old = self.get_pragmas(list(settings))
+        conn = self.__get_conn()
+        for name, value in settings.items():
+            conn.execute("pragma {} = {}".format(name, value))
+        try:
+            yield
+        finally:
+            for name, value in old.items():
+                conn.execute("pragma {} = {}".format(name, value))
+
+    def __drop_indexes(self, table):
+        """Drops secondary indexes of table; returns their "create index" statements"""
+        rows = self.execute("select name, sql from sqlite_master "
+                            "where type = 'index' and tbl_name = ? and sql is not null",
+                            (table,)).fetchall()
+        for row in rows:
+            self.execute("drop index {}".format(_quote(row[0])))
+        return [row[1] for row in rows]
+
+    def __current_conn(self):
+        """Returns connection for current thread (thread-local mode) or the single connection"""
+        if not self.flag_thread_local:
+            return self.__conn
+        if getattr(self.__local, "generation", None) != self.__generation:
+            return None
+        return self.__local.thread_conn.conn
+
+    def __set_current_conn(self, conn):
+        if not self.flag_thread_local:
+            self.__conn = conn
+            return
+        thread_conn = _ThreadConn(conn)
+        with self.__lock:
+            self.__local.thread_conn = thread_conn
+            self.__local.generation = self.__generation
+            self.__thread_conns.add(thread_conn)
+
     def __conn_is_open(self):
-        """Tests sqlite3 connection, returns T/F"""
-        if self.__conn is None:
-            return False
+        """Returns whether there is an open connection, without querying the database.
 
-        try:
-            self.__get_table_names(self.__conn)
-            return True
-        except sqlite3.ProgrammingError as e:
-            return False
+        **Note** connections are owned by this object: they are only closed by close_if_open()
+                 (or, in thread-local mode, when their thread ends)
+        """
+        return self.__current_conn() is not None
 
     def __get_conn(self, flag_force_new=False, filename=None):
         """Returns connection to database. Tries to return existing connection, unless flag_force_new
@@ -162,24 +862,116 @@ class FileSQLiteDB(object):
             if filename is None:
                 filename = self.filename
             # funny that __get_conn() calls _get_conn() but that's it
-            conn = self.__get_conn_really(filename)
-            self.__conn = conn
+            # In thread-local mode, connections may be closed by another thread (close_if_open())
+            conn = self.__get_conn_really(filename, check_same_thread=not self.flag_thread_local)
+            self.__set_current_conn(conn)
         else:
-            conn = self.__conn
+            conn = self.__current_conn()
         return conn
 
-    def __get_conn_really(self, filename):
+    def __get_conn_really(self, filename, check_same_thread=True):
         # https://stackoverflow.com/questions/1829872/how-to-read-datetime-back-from-sqlite-as-a-datetime-instead-of-string-in-python
-        conn = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES)
+        flag_memory = self.flag_in_memory and filename == self.filename
+        if self.flag_read_only:
+            # https://www.sqlite.org/uri.html
+            filename = "file:{}?mode=ro{}{}".format(urllib.parse.quote(os.path.abspath(filename)),
+                                                    "&immutable=1" if self.flag_immutable else "",
+                                                    "&cache=shared" if self.flag_shared_cache else "")
+        elif flag_memory:
+            self.__load_memory()
+            filename = self.__memory_uri
+        conn = sqlite3.connect(filename, detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=check_same_thread,
+                               uri=self.flag_read_only or flag_memory)
         # I think this will give rows with both numeric and string indexes
         conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            if name == "journal_mode" and (self.flag_read_only or flag_memory):
+                # Would need to write to the file / memory databases have their own journal
+                continue
+            conn.execute("pragma {} = {}".format(name, value))
 
         return conn
 
+    def __load_memory(self):
+        """Opens the memory database (if not open yet), loading the file into it"""
+        with self.__memory_lock:
+            if self.__memory is not None:
+                return
+            memory = sqlite3.connect(self.__memory_uri, uri=True, check_same_thread=False)
+            try:
+                if os.path.isfile(self.filename):
+                    src = sqlite3.connect(self.filename)
+                    try:
+                        # A WAL-mode header would make the memory database unreadable
+                        if src.execute("pragma journal_mode").fetchone()[0] == "wal":
+                            src.execute("pragma journal_mode = delete")
+                        src.backup(memory)
+                    finally:
+                        src.close()
+            except BaseException:
+                memory.close()
+                raise
+            self.__memory = memory
+            self.__unsaved_writes = 0
+            self.__total_changes = {}
+            _in_memory_dbs.add(self)
+            if self.snapshot_interval is not None:
+                self.__snapshot_stop.clear()
+                self.__snapshot_thread = threading.Thread(target=self.__snapshot_main,
+                                                          name="FileSQLiteDB-snapshot",
+                                                          daemon=True)
+                self.__snapshot_thread.start()
+
+    def __close_memory(self):
+        """Stops snapshot thread, takes last snapshot and frees the memory database"""
+        if self.__snapshot_thread is not None:
+            self.__snapshot_stop.set()
+            self.__snapshot_thread.join()
+            self.__snapshot_thread = None
+        with self.__memory_lock:
+            if self.__memory is None:
+                return
+            try:
+                self.snapshot()
+            finally:
+                self.__memory.close()
+                self.__memory = None
+                _in_memory_dbs.discard(self)
+
+    def __snapshot_main(self):
+        while not self.__snapshot_stop.wait(self.snapshot_interval):
+            if self.__unsaved_writes > 0:
+                try:
+                    self.snapshot()
+                except sqlite3.Error:
+                    # e.g., busy; tries again at next tick
+                    pass
+
+    def __count_writes(self, conn):
+        """Adds rows changed by conn since last call to the unsaved writes; snapshots if due"""
+        total = conn.total_changes
+        self.__unsaved_writes += max(0, total-self.__total_changes.get(id(conn), 0))
+        self.__total_changes[id(conn)] = total
+        if self.snapshot_writes is not None and self.__unsaved_writes >= self.snapshot_writes:
+            self.snapshot()
+
     def __close_if_open(self):
-        if self.__conn_is_open():
+        if self.__conn is not None:
             self.__conn.close()
             self.__conn = None
+        with self.__lock:
+            thread_conns, self.__thread_conns = list(self.__thread_conns), weakref.WeakSet()
+            conns, self.__pool_conns = self.__pool_conns, []
+            self.__generation += 1
+        self.__pool_idle = queue.LifoQueue()
+        for thread_conn in thread_conns:
+            thread_conn.close()
+        for conn in conns:
+            conn.close()
+        if self.flag_in_memory:
+            # After closing the connections, so that no transaction is left open
+            self.__close_memory()
 
     def __ensure_filename(self):
         if self.filename is None:
@@ -191,20 +983,216 @@ class FileSQLiteDB(object):
         conn.commit()
 
 
-def get_table_info(conn, tablename):
+class _ThreadConn(object):
+    """Connection of one thread (thread-local mode), closed when this object is garbage-collected,
+    i.e., when the thread ends and its thread-local storage goes away."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.close = weakref.finalize(self, conn.close)
+
+
+class _QueryStats(object):
+    """Statement statistics collected by FileSQLiteDB when instrumentation is enabled."""
+
+    def __init__(self, slow_threshold, slow_callback, max_samples):
+        self.slow_threshold = slow_threshold
+        self.slow_callback = slow_callback
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        # {sql: _StatementStats, ...}
+        self.statements = {}
+        self.slow_queries = deque(maxlen=100)
+
+    def run(self, conn, method, args, kwargs):
+        """Calls method(*args, **kwargs) recording statistics; returns _CountingCursor"""
+        sql = args[0] if args else kwargs["sql"]
+        params = args[1] if len(args) > 1 else kwargs.get("parameters", ())
+        if method == conn.executemany:
+            # Plans with the first set of parameters, taken before executemany() consumes them
+            # (they may come from a generator)
+            it = iter(params)
+            first = next(it, None)
+            if first is not None:
+                it = itertools.chain((first,), it)
+            args, kwargs = (sql, it), {}
+            params = () if first is None else first
+        t = time.perf_counter()
+        cursor = method(*args, **kwargs)
+        elapsed = time.perf_counter()-t
+
+        st = self.statements.get(sql)
+        if st is None:
+            st = self.statements[sql] = _StatementStats(self.max_samples)
+        st.count += 1
+        st.total += elapsed
+        st.samples.append(elapsed)
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.__log_slow(conn, sql, params, elapsed)
+        return _CountingCursor(cursor, st)
+
+    def get_stats(self):
+        ret = OrderedDict()
+        for sql, st in self.statements.items():
+            samples = sorted(st.samples)
+            ret[sql] = {"count": st.count, "total": st.total, "mean": st.total/st.count,
+                        "p50": _percentile(samples, .50), "p95": _percentile(samples, .95),
+                        "p99": _percentile(samples, .99), "max": samples[-1], "rows": st.rows}
+        return ret
+
+    def __log_slow(self, conn, sql, params, elapsed):
+        try:
+            plan = [row[-1] for row in conn.execute("explain query plan "+sql, params)]
+        except sqlite3.Error as e:
+            plan = ["(cannot explain: {})".format(e)]
+        self.slow_queries.append({"sql": sql, "elapsed": elapsed, "plan": plan})
+        if self.slow_callback is not None:
+            self.slow_callback(sql, elapsed, plan)
+
+
+class _StatementStats(object):
+    def __init__(self, max_samples):
+        self.count = 0
+        self.total = 0.
+        self.rows = 0
+        self.samples = deque(maxlen=max_samples)
+
+
+class _CountingCursor(object):
+    """Wraps sqlite3.Cursor counting rows fetched into a _StatementStats"""
+
+    def __init__(self, cursor, st):
+        self.__cursor = cursor
+        self.__st = st
+
+    def __getattr__(self, name):
+        return getattr(self.__cursor, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_CountingCursor__"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.__cursor, name, value)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.__cursor)
+        self.__st.rows += 1
+        return row
+
+    def fetchone(self):
+        row = self.__cursor.fetchone()
+        if row is not None:
+            self.__st.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self.__cursor.fetchmany(*args, **kwargs)
+        self.__st.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.__cursor.fetchall()
+        self.__st.rows += len(rows)
+        return rows
+
+
+@atexit.register
+def _snapshot_in_memory_dbs():
+    for db in list(_in_memory_dbs):
+        try:
+            db.close_if_open()
+        except Exception:
+            pass
+
+
+def _new_lock_stats():
+    return {"lock_errors": 0, "retries": 0, "failures": 0, "wait_time": 0.}
+
+
+def _is_lock_error(e):
+    msg = str(e)
+    return "database is locked" in msg or "database is busy" in msg or \
+           "database table is locked" in msg
+
+
+def _quote(identifier):
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def _iter_array_rows(array, chunk_size):
+    """Generates rows of NumPy array as Python tuples, converting chunk_size rows at a time"""
+    for i in range(0, len(array), chunk_size):
+        for row in array[i:i+chunk_size].tolist():
+            yield tuple(row) if isinstance(row, list) else row
+
+
+def _bulk_stats(n, elapsed):
+    return {"rows": n, "elapsed": elapsed, "rows_per_second": n/elapsed if elapsed > 0 else 0.}
+
+
+def _infer_dtype(rows, i):
+    """Returns NumPy dtype for column i based on sample rows (see FileSQLiteDB.fetch_columns())"""
+    types = {type(row[i]) for row in rows}
+    types.discard(type(None))
+    if not types or types <= {float, int}:
+        if types == {int} and all(row[i] is not None for row in rows):
+            return np.int64
+        return np.float64
+    return object
+
+
+def _widen_dtype(dtype, other):
+    """Returns the wider of two dtypes returned by _infer_dtype() (dtype may be None)"""
+    if dtype is None:
+        return other
+    order = [np.int64, np.float64, object]
+    return order[max(order.index(dtype), order.index(other))]
+
+
+def _percentile(sorted_samples, q):
+    return sorted_samples[min(len(sorted_samples)-1, int(q*len(sorted_samples)))]
+
+
+def get_table_info(conn, tablename, cache=None):
     """
     Returns information about fields of a specific table
 
     Args:
         conn: sqlite3 Connection object
         tablename: string
+        cache: (optional) dict to keep results in between calls. Cached results are discarded
+               when the schema version of the database changes. The same dict can be shared by
+               all calls on a given database
 
     Returns:
-        {"fieldname": row, ...}
+        {"fieldname": row, ...} (empty if table does not exist)
     """
 
+    if cache is not None:
+        cache = _validate_schema_cache(conn, cache)
+        ret = cache.get(("table_info", tablename))
+        if ret is not None:
+            return OrderedDict(ret)
+
     r = conn.execute("pragma table_info('{}')".format(tablename))
-    ret = OrderedDict(((row["name"], row) for row in r))
+    # Column #1 is "name"
+    ret = OrderedDict(((row[1], row) for row in r))
+    if cache is not None:
+        cache[("table_info", tablename)] = OrderedDict(ret)
     return ret
 
 
+def _validate_schema_cache(conn, cache):
+    """Empties schema cache if schema version has changed since it was filled; returns cache."""
+    version = conn.execute("pragma schema_version").fetchone()[0]
+    if cache.get("schema_version") != version:
+        cache.clear()
+        cache["schema_version"] = version
+    return cache
+
+
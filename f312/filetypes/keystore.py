@@ -1,19 +1,137 @@
 from .filesqlitedb import FileSQLiteDB
+from .valuecodecs import ValueCodec, SER_PICKLE_LEGACY, SER_CHUNKED
 import pickle as pkl
 import asyncio
+import io
+import os
+import sqlite3
+import atexit
+import contextlib
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping, ValuesView, ItemsView
 
 
-__all__ = ["Keystore"]
+__all__ = ["Keystore", "migrate_keystore"]
 
-class Keystore(FileSQLiteDB):
-    def __init__(self, *args, flag_auto_commit=True, **kwargs):
-        super().__init__(*args, **kwargs)
+
+# Maximum number of keys bound in a single batch lookup. SQLite's default limit for host
+# parameters is 999 in older builds
+_MAX_BATCH_PARAMS = 500
+
+# Returned by _LRUCache.get() when key is not cached
+_MISSING = object()
+
+# Keystores in write-behind mode, to be flushed at interpreter exit
+_write_behind_stores = weakref.WeakSet()
+
+
+class Keystore(FileSQLiteDB, MutableMapping):
+    """Persistent key-value store backed by a SQLite file.
+
+    Implements the MutableMapping protocol. Iteration (including keys(), values() and items())
+    streams rows from the database in batches of fetch_size rows, in key order.
+
+    Args:
+        flag_auto_commit: commits after every write
+        flag_write_behind: enables write-behind mode: writes are kept in memory (and are visible
+                           to reads) until write_behind_entries have accumulated or
+                           write_behind_ms milliseconds have passed since the oldest pending write;
+                           they are then written in a single transaction. The time limit is
+                           enforced by a background thread with its own connection, so that idle
+                           stores get flushed too. Pending writes are also flushed by commit(),
+                           flush(), close_if_open() and at interpreter exit. flag_auto_commit has
+                           no effect in this mode. Not available in in-memory mode
+        write_behind_entries: maximum number of pending writes
+        write_behind_ms: maximum age of the oldest pending write, in milliseconds
+        cache_entries: enables a LRU cache of decoded values holding up to this many entries
+                       (0 disables the cache). Not available with flag_thread_local. **Note**
+                       cached values are shared between reads, so they should not be modified in
+                       place; writes made through other Keystore objects or processes are not
+                       seen while a key stays cached
+        cache_bytes: (optional) further limits the cache to this approximate size in bytes (size
+                     of the encoded values)
+        codec: ValueCodec instance used to encode values (defaults to highest-protocol pickle
+               without compression). Each row records how it was encoded, so that changing the
+               codec does not affect reading existing values. Files created before codec tags
+               existed are left as they are (older code may still be using them): values are
+               read and written as plain pickle, and open_value("wb") is not available until
+               the file is converted by migrate_keystore()
+        flag_ttl: enables per-key expiry (see set()). Adds an indexed "expires" column to the
+                  table if not present yet. Expired keys read as missing; they are removed from
+                  the file by purge_expired() (see also start_purge_thread()). Files that already
+                  have the column always honour expiry
+        default_ttl: (seconds) time-to-live of keys written without explicit ttl (None: never
+                     expire). Implies flag_ttl
+        layout: table layout of new files (existing files keep theirs, see the layout attribute
+                and migrate_keystore()):
+                - 1 (legacy): "key string" (numeric affinity: e.g. key "0012" is stored as 12),
+                  "value text", plus an index duplicating the primary key
+                - 2: WITHOUT ROWID table with TEXT key and BLOB value, no extra index. Marked by
+                  "PRAGMA user_version = 2"
+    """
+
+    def __init__(self, *args, flag_auto_commit=True, flag_write_behind=False,
+                 write_behind_entries=1000, write_behind_ms=1000., cache_entries=0,
+                 cache_bytes=None, codec=None, flag_ttl=False, default_ttl=None, layout=2,
+                 **kwargs):
+        if layout not in (1, 2):
+            raise ValueError("Invalid layout: {}".format(layout))
+        if flag_write_behind and kwargs.get("flag_in_memory"):
+            raise ValueError("flag_write_behind cannot be combined with in-memory mode")
+        if cache_entries > 0 and kwargs.get("flag_thread_local"):
+            # Threads would fill the cache from their own connections, e.g. with values that
+            # another thread is about to replace
+            raise ValueError("cache_entries cannot be combined with flag_thread_local")
         self.flag_auto_commit = flag_auto_commit
+        self.flag_write_behind = flag_write_behind
+        self.write_behind_entries = write_behind_entries
+        self.write_behind_ms = write_behind_ms
+        self.codec = codec if codec is not None else ValueCodec()
+        self.default_ttl = default_ttl
+        # {key: (encoded value, codec tag, expiry time), ...} waiting to be written (write-behind
+        # mode)
+        self.__pending = {}
+        self.__pending_since = None
+        # Guards pending writes against the background flusher
+        self.__pending_lock = threading.RLock()
+        self.__flusher = None
+        self.__flusher_stop = threading.Event()
+        self.__cache = _LRUCache(cache_entries, cache_bytes) if cache_entries > 0 else None
+        # SQL expression for the codec tag ("null" for files without codec column)
+        self.__codec_col = "codec"
+        # Whether table has column "expires"
+        self.__flag_ttl = False
+        self.__purge_thread = None
+        self.__purge_stop = threading.Event()
+        # Layout of the file (layout of new files until the schema is created)
+        self.layout = layout
+        super().__init__(*args, **kwargs)
+        self.layout = 2 if self.execute("pragma user_version").fetchone()[0] == 2 else 1
+        self.__detect_codec_column()
+        self.__ensure_ttl_column(flag_ttl or default_ttl is not None)
+        if flag_write_behind:
+            _write_behind_stores.add(self)
+
+    # Number of rows fetched at a time when iterating over the store
+    fetch_size = 1000
+
+    # Size (bytes) of the rows holding values written through open_value()
+    value_chunk_size = 1048576
+
+    # Stores compare and hash by identity, not by contents
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
     async def async_commit(self):
         """
         Asynchronous version of commit().
 
         https://stackoverflow.com/questions/52682336/async-sqlite-python
+
+        **Note** for non-blocking reads and writes from asyncio code, see AsyncKeystore
         """
         loop = asyncio.get_event_loop()
         return await loop.run_in_executor(None, lambda: self.commit())
@@ -26,40 +144,886 @@ class Keystore(FileSQLiteDB):
         return default
 
     def __getitem__(self, key):
-        conn = self.get_conn()
-        cursor = conn.execute("select value from data where key = ?", (key,))
+        item = self.__get_pending(key)
+        if item is not _MISSING:
+            if item is None:
+                raise KeyError(f"Key not found: '{key}'")
+            return self._decode(*item)
+        if self.__cache is not None:
+            res = self.__cache.get(key)
+            if res is not _MISSING:
+                return res
+
+        where, params = self.__where(["key = ?"], [key])
+        cursor = self.execute("select value, {}{} from data{}".format(
+                              self.__codec_col, ", expires" if self.__flag_ttl else "", where),
+                              params)
         __res = cursor.fetchone()
         if __res is None:
             raise KeyError(f"Key not found: '{key}'")
 
         _res = __res[0]
-        res = self._unpickle(_res)
+        res = self._decode(_res, __res[1])
+        if self.__flag_cache_fill() and __res[1] != SER_CHUNKED:
+            self.__cache.put(key, res, len(_res), __res[2] if self.__flag_ttl else None)
         return res
 
     def __setitem__(self, key, value):
-        n = self.execute("select count(*) from data where key = ?", (key,)).fetchone()[0]
-        value_ = self._pickle(value)
-        if n > 0:
-            self.execute("update data set value = ? where key = ?", (value_, key))
+        self.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Stores value under key.
+
+        Args:
+            key: key
+            value: value
+            ttl: time-to-live (seconds). Defaults to self.default_ttl. Requires expiry to be
+                 enabled (see flag_ttl)
+        """
+        self._check_writable()
+        expires = self.__get_expires(ttl)
+        if self.__cache is not None:
+            self.__cache.discard(key)
+        value_, codec = self._encode(value)
+        if self.flag_write_behind:
+            self.__add_pending(((key, (value_, codec, expires)),))
+            return
+
+        with self.__write_block(self.flag_auto_commit):
+            self.__write_rows(((key, value_, codec, expires),))
+
+    def __delitem__(self, key):
+        self._check_writable()
+        if self.__cache is not None:
+            self.__cache.discard(key)
+        where, params = self.__where(["key = ?"], [key])
+        with self.__pending_lock:
+            flag_pending = self.__pending.pop(key, None) is not None
+            with self.__write_block(self.flag_auto_commit or self.flag_write_behind):
+                n = self.execute("delete from data"+where, params).rowcount
+                if n == 0 and self.__flag_ttl:
+                    # Expired row, if any
+                    self.execute("delete from data where key = ?", (key,))
+        if n == 0 and not flag_pending:
+            raise KeyError(f"Key not found: '{key}'")
+
+    def __contains__(self, key):
+        item = self.__get_pending(key)
+        if item is not _MISSING:
+            return item is not None
+        where, params = self.__where(["key = ?"], [key])
+        return self.execute("select 1 from data"+where, params).fetchone() is not None
+
+    def __len__(self):
+        if self.__pending:
+            self.commit()
+        where, params = self.__where()
+        return self.execute("select count(*) from data"+where, params).fetchone()[0]
+
+    def __iter__(self):
+        where, params = self.__where()
+        for row in self.__iter_rows("select key from data{} order by key".format(where), params):
+            yield row[0]
+
+    def values(self):
+        return _ValuesView(self)
+
+    def items(self):
+        return _ItemsView(self)
+
+    def clear(self):
+        """Deletes all entries."""
+        self._check_writable()
+        if self.__cache is not None:
+            self.__cache.clear()
+        with self.__pending_lock:
+            self.__pending.clear()
+            with self.__write_block(self.flag_auto_commit or self.flag_write_behind):
+                self.execute("delete from data")
+
+    def update(self, other=(), **kwargs):
+        """Same as dict.update(), but stores using set_many()."""
+        self.set_many(other)
+        if kwargs:
+            self.set_many(kwargs)
+
+    def scan_prefix(self, prefix):
+        """Generates (key, value) for keys starting with prefix, in key order.
+
+        Uses the primary key index as a range scan. **Note** only text keys are matched (the
+        "string" key column of layout 1 stores numeric-looking keys as numbers).
+        """
+        yield from self.scan_range(prefix, _prefix_upper_bound(prefix))
+
+    def scan_range(self, lo=None, hi=None):
+        """Generates (key, value) for lo <= key < hi, in key order. lo/hi may be None (unbounded)
+        """
+        conds, params = [], []
+        if lo is not None:
+            conds.append("key >= ?")
+            params.append(lo)
+        if hi is not None:
+            conds.append("key < ?")
+            params.append(hi)
+        where, params = self.__where(conds, params)
+        yield from self._iter_items("select key, value, {} from data{} order by key".
+                                    format(self.__codec_col, where), params)
+
+    def commit(self):
+        """Writes pending writes (if any) and commits."""
+        with self.__pending_lock:
+            if self.__pending:
+                pending, self.__pending = self.__pending, {}
+                try:
+                    with self.__write_block(True):
+                        self.__write_rows([(key,)+item for key, item in pending.items()])
+                except BaseException:
+                    pending.update(self.__pending)
+                    self.__pending = pending
+                    raise
+            self.__pending_since = None
+        super().commit()
+
+    def flush(self):
+        """Flushes pending writes to disk in a single transaction. Same as commit()."""
+        self.commit()
+
+    def close_if_open(self):
+        self.stop_purge_thread()
+        self.__stop_flusher()
+        if self.__pending:
+            self.commit()
+        return super().close_if_open()
+
+    def get_cache_stats(self):
+        """Returns read cache statistics as a dict, or None if cache is disabled."""
+        if self.__cache is None:
+            return None
+        return self.__cache.get_stats()
+
+    def clear_cache(self):
+        """Empties the read cache (hit/miss counters are kept)."""
+        if self.__cache is not None:
+            self.__cache.clear()
+
+    # # Expiry
+    #   ======
+
+    @property
+    def flag_ttl(self):
+        """Whether per-key expiry is enabled"""
+        return self.__flag_ttl
+
+    def purge_expired(self, batch_size=1000, max_batches=None):
+        """Deletes expired rows from the file, batch_size rows per transaction.
+
+        Args:
+            batch_size: maximum number of rows deleted per transaction (keeps locks short)
+            max_batches: maximum number of transactions (None: until no expired rows are left)
+
+        Returns:
+            number of rows deleted
+        """
+        self._check_writable()
+        if not self.__flag_ttl:
+            return 0
+        ret, num_batches = 0, 0
+        while max_batches is None or num_batches < max_batches:
+            with self.__write_block(True):
+                n = self.execute("delete from data where key in (select key from data "
+                                 "where expires <= ? order by expires limit ?)",
+                                 (time.time(), batch_size)).rowcount
+            ret += n
+            num_batches += 1
+            if n < batch_size:
+                break
+        return ret
+
+    def start_purge_thread(self, interval=60., batch_size=1000):
+        """Starts daemon thread calling purge_expired() every interval seconds.
+
+        The thread uses its own connection to the file. Stopped by stop_purge_thread() or
+        close_if_open().
+        """
+        if not self.__flag_ttl:
+            raise RuntimeError("Expiry is not enabled (see flag_ttl)")
+        if self.flag_in_memory:
+            raise RuntimeError("Purge thread not available in in-memory mode "
+                               "(call purge_expired() instead)")
+        if self.__purge_thread is not None:
+            return
+        self.__purge_stop.clear()
+        self.__purge_thread = threading.Thread(target=self.__purge_main,
+                                               args=(interval, batch_size),
+                                               name="Keystore-purge", daemon=True)
+        self.__purge_thread.start()
+
+    def stop_purge_thread(self):
+        if self.__purge_thread is not None:
+            self.__purge_stop.set()
+            self.__purge_thread.join()
+            self.__purge_thread = None
+
+    # # Batch operations
+    #   ================
+
+    def set_many(self, items, ttl=None):
+        """Stores many key-value pairs in a single transaction.
+
+        Args:
+            items: mapping or iterable of (key, value) pairs
+            ttl: time-to-live (seconds) for all items (see set())
+
+        Returns:
+            number of pairs stored
+        """
+        self._check_writable()
+        expires = self.__get_expires(ttl)
+        if hasattr(items, "items"):
+            items = items.items()
+        rows = [(key,)+self._encode(value)+(expires,) for key, value in items]
+        if self.__cache is not None:
+            for row in rows:
+                self.__cache.discard(row[0])
+        if self.flag_write_behind:
+            self.__add_pending([(row[0], row[1:]) for row in rows])
         else:
-            self.execute("insert into data values (?, ?)", (key, value_))
-        if self.flag_auto_commit:
+            with self.__write_block(self.flag_auto_commit):
+                self.__write_rows(rows)
+        return len(rows)
+
+    def get_many(self, keys):
+        """Retrieves many keys at once, a few hundred keys per statement.
+
+        Returns:
+            {key: value, ...} containing only the keys that were found
+        """
+        ret = {}
+        keys = list(keys)
+        if self.__cache is not None:
+            for key in keys:
+                value = self.__cache.get(key)
+                if value is not _MISSING:
+                    ret[key] = value
+            keys = [key for key in keys if key not in ret]
+        if self.__pending:
+            keys_ = []
+            for key in keys:
+                item = self.__get_pending(key)
+                if item is _MISSING:
+                    keys_.append(key)
+                elif item is not None:
+                    ret[key] = self._decode(*item)
+            keys = keys_
+        flag_cache_fill = self.__flag_cache_fill()
+        for i in range(0, len(keys), _MAX_BATCH_PARAMS):
+            chunk = keys[i:i+_MAX_BATCH_PARAMS]
+            # Joins against a list of (position, key) so that results are mapped back to the keys
+            # exactly as requested (column "key" may coerce the type of stored keys)
+            where, params = self.__where((), chunk)
+            sql = "with req(pos, key) as (values {}) " \
+                  "select req.pos, data.value, {}{} from req join data " \
+                  "on data.key = req.key{}". \
+                  format(",".join("({}, ?)".format(j) for j in range(len(chunk))),
+                         self.__codec_col, ", data.expires" if self.__flag_ttl else "", where)
+            for row in self.execute(sql, params):
+                key, value = chunk[row[0]], self._decode(row[1], row[2])
+                ret[key] = value
+                if flag_cache_fill and row[2] != SER_CHUNKED:
+                    self.__cache.put(key, value, len(row[1]), row[3] if self.__flag_ttl else None)
+        return ret
+
+    def delete_many(self, keys):
+        """Deletes many keys in a single transaction. Missing keys are ignored.
+
+        In write-behind mode, pending writes are flushed first.
+
+        Returns:
+            number of rows deleted
+        """
+        self._check_writable()
+        if self.__pending:
             self.commit()
-        return value
+        keys = list(keys)
+        if self.__cache is not None:
+            for key in keys:
+                self.__cache.discard(key)
+        with self.__write_block(self.flag_auto_commit or self.flag_write_behind):
+            cursor = self.executemany("delete from data where key = ?", [(key,) for key in keys])
+        return cursor.rowcount
+
+    # # Streaming values
+    #   ================
+
+    def open_value(self, key, mode="rb"):
+        """Opens the value of key as a binary file, for values too big to handle in one piece.
+
+        Values written this way are stored in rows of value_chunk_size bytes in a side table
+        ("value_chunks"), so neither writing nor reading needs the whole value in memory. They
+        read back as bytes through the mapping interface too, and share the store with regular
+        values. Reads use SQLite incremental blob I/O when available (Python 3.11+).
+
+        Args:
+            key: key
+            mode: "rb" or "wb". "rb" also opens regular values of type bytes. "wb" keeps a write
+                  transaction open until the file is closed; if the with block raises, nothing is
+                  written
+
+        Usage:
 
+            with ks.open_value("big", "wb") as f:
+                for part in parts:
+                    f.write(part)
+            with ks.open_value("big") as f:
+                header = f.read(16)
+
+        **Note** once the chunk table exists, every insert into the store costs an extra primary
+                 key lookup (a trigger removing the chunks of replaced values)
+        """
+        if mode == "rb":
+            item = self.__get_pending(key)
+            if item is not _MISSING:
+                if item is None:
+                    raise KeyError(f"Key not found: '{key}'")
+                value_, codec = item
+            else:
+                where, params = self.__where(["key = ?"], [key])
+                row = self.execute("select value, {} from data{}".format(self.__codec_col, where),
+                                   params).fetchone()
+                if row is None:
+                    raise KeyError(f"Key not found: '{key}'")
+                value_, codec = row[0], row[1]
+            if codec != SER_CHUNKED:
+                value = self._decode(value_, codec)
+                if not isinstance(value, (bytes, bytearray)):
+                    raise TypeError("Value of key '{}' is not bytes ({})".format(
+                                    key, type(value).__name__))
+                return io.BytesIO(value)
+            chunks = self.execute("select id, length(data) from value_chunks "
+                                  "where blob_id = ? order by seq", (int(value_),)).fetchall()
+            return io.BufferedReader(_ValueReader(self, [tuple(row) for row in chunks]))
+        if mode == "wb":
+            self._check_writable()
+            self._ensure_chunk_table()
+            if self.__pending:
+                # Pending writes of key would overwrite the streamed value later on
+                self.commit()
+            if self.__cache is not None:
+                self.__cache.discard(key)
+            return _ValueWriter(self, key)
+        raise ValueError("Invalid mode: '{}' (valid: 'rb', 'wb')".format(mode))
+
+    def _read_value_chunk(self, rowid, offset, size):
+        """Returns size bytes from offset of a value chunk (see open_value())"""
+        conn = self.get_conn()
+        if hasattr(conn, "blobopen"):
+            with conn.blobopen("value_chunks", "data", rowid, readonly=True) as blob:
+                blob.seek(offset)
+                return blob.read(size)
+        return self.execute("select substr(data, ?, ?) from value_chunks where id = ?",
+                            (offset+1, size, rowid)).fetchone()[0]
+
+    # Called by _ValueWriter inside its transaction
+
+    def _new_value_blob_id(self):
+        return self.execute("select coalesce(max(blob_id), 0)+1 from value_chunks").fetchone()[0]
+
+    def _write_value_chunks(self, blob_id, seq, chunks):
+        """Inserts chunks numbered from seq"""
+        self.executemany("insert into value_chunks (blob_id, seq, data) values (?, ?, ?)",
+                         ((blob_id, seq+i, chunk) for i, chunk in enumerate(chunks)))
+
+    def _set_chunked_value(self, key, blob_id):
+        self.__write_rows(((key, blob_id, SER_CHUNKED, None),))
 
     # OVERRIDEN
 
+    def _iter_items(self, sql=None, params=()):
+        """Generates (key, value) from a query returning (key, value, codec) rows.
+
+        Defaults to all items in key order."""
+        if sql is None:
+            where, params = self.__where()
+            sql = "select key, value, {} from data{} order by key".format(self.__codec_col, where)
+        for key, value_, codec in self.__iter_rows(sql, params):
+            yield key, self._decode(value_, codec)
+
     def _create_schema(self, cursor):
         """Responsible for executing the CREATE TABLE statements"""
         conn = self.get_conn()
-        conn.execute("create table data (key string not null primary key,"
-                            "value text)")
-        conn.execute("create index data_key on data (key)")
+        if self.layout == 1:
+            conn.execute("create table data (key string not null primary key,"
+                                "value text, codec integer)")
+            conn.execute("create index data_key on data (key)")
+        else:
+            conn.execute("create table data (key text not null primary key, value blob, "
+                         "codec integer) without rowid")
+            conn.execute("pragma user_version = 2")
         self.commit()
 
     def _pickle(self, obj):
         return pkl.dumps(obj)
 
     def _unpickle(self, s):
-        return pkl.loads(s)
\ No newline at end of file
+        return pkl.loads(s)
+
+    def _encode(self, value):
+        """Returns (encoded value, codec tag)."""
+        if type(self)._pickle is not Keystore._pickle or self.__codec_col == "null":
+            # Honours subclasses that customize pickling, and files without codec column
+            return self._pickle(value), SER_PICKLE_LEGACY
+        return self.codec.encode(value)
+
+    def _decode(self, value_, codec):
+        if codec == SER_CHUNKED:
+            return b"".join(row[0] for row in self.execute(
+                            "select data from value_chunks where blob_id = ? order by seq",
+                            (int(value_),)))
+        if not codec:
+            # Row written without codec tag or by _pickle()
+            return self._unpickle(value_)
+        return self.codec.decode(value_, codec)
+
+    # # Internal gear
+    #   =============
+
+    @contextlib.contextmanager
+    def __write_block(self, flag_commit):
+        """Runs write statements; if flag_commit, in a "BEGIN IMMEDIATE" transaction that commits.
+
+        Inside an already open transaction, statements just join it.
+        """
+        if flag_commit and not self.get_conn().in_transaction:
+            with self.transaction(flag_immediate=True):
+                yield
+        else:
+            yield
+
+    def __flag_cache_fill(self):
+        """Whether values read now may go into the cache: not if read inside a transaction, which
+        may still be rolled back.
+
+        **Note** values written through open_value() are never cached: their data column only
+        refers to the chunks
+        """
+        return self.__cache is not None and not self.get_conn().in_transaction
+
+    def __where(self, conds=(), params=()):
+        """Returns (" where ..." SQL, params), adding a condition that excludes expired rows."""
+        conds, params = list(conds), list(params)
+        if self.__flag_ttl:
+            conds.append("(expires is null or expires > ?)")
+            params.append(time.time())
+        return (" where "+" and ".join(conds) if conds else ""), params
+
+    def __write_rows(self, rows):
+        """Inserts/replaces (key, encoded value, codec tag, expiry time) rows."""
+        flags = (True, True, self.__codec_col != "null", self.__flag_ttl)
+        names = [name for name, flag in zip(("key", "value", "codec", "expires"), flags) if flag]
+        rows = (tuple(x for x, flag in zip(row, flags) if flag) for row in rows)
+        self.executemany("insert or replace into data ({}) values ({})".format(
+                         ", ".join(names), ", ".join("?"*len(names))), rows)
+
+    def __get_expires(self, ttl):
+        """Converts time-to-live into expiry time"""
+        if ttl is None:
+            ttl = self.default_ttl
+        if ttl is None:
+            return None
+        if not self.__flag_ttl:
+            raise RuntimeError("Expiry is not enabled (see flag_ttl)")
+        return time.time()+ttl
+
+    def __get_pending(self, key):
+        """Returns (encoded value, codec tag) from pending writes, None if expired there, or
+        _MISSING if key has no pending write.
+
+        Looks key up only once: the flusher may write out and clear pending writes at any time
+        (after committing them, so a key no longer pending can be read from the file)
+        """
+        item = self.__pending.get(key, _MISSING)
+        if item is _MISSING:
+            return item
+        if item[2] is not None and item[2] <= time.time():
+            return None
+        return item[:2]
+
+    def __stop_flusher(self):
+        if self.__flusher is not None:
+            self.__flusher_stop.set()
+            self.__flusher.join()
+            self.__flusher = None
+
+    def __flusher_main(self):
+        """Writes pending writes once the oldest is write_behind_ms old (runs in a thread)"""
+        writer = None
+        try:
+            while not self.__flusher_stop.wait(max(self.write_behind_ms/4000., 0.001)):
+                since = self.__pending_since
+                if since is None or (time.monotonic()-since)*1000 < self.write_behind_ms:
+                    continue
+                try:
+                    if writer is None:
+                        writer = Keystore(self.filename, pragmas=self.pragmas,
+                                          max_retries=self.max_retries)
+                    writer.__write_pending_of(self)
+                except Exception:
+                    # e.g., database locked; tries again at next tick
+                    pass
+        finally:
+            if writer is not None:
+                writer.close_if_open()
+
+    def __write_pending_of(self, ks):
+        """Writes and commits pending writes of ks through this object's connection.
+
+        Takes the database write lock first, then waits briefly for the pending writes lock of ks:
+        if ks is busy writing through its own connection, gives up, to be tried again later.
+        """
+        lock = ks.__pending_lock
+        flag_locked = False
+        try:
+            with self.transaction(flag_immediate=True):
+                flag_locked = lock.acquire(timeout=0.05)
+                if not flag_locked or not ks.__pending:
+                    return
+                self.__write_rows([(key,)+item for key, item in ks.__pending.items()])
+            ks.__pending.clear()
+            ks.__pending_since = None
+        finally:
+            if flag_locked:
+                lock.release()
+
+    def __purge_main(self, interval, batch_size):
+        ks = Keystore(self.filename, pragmas=self.pragmas, max_retries=self.max_retries)
+        try:
+            while not self.__purge_stop.wait(interval):
+                ks.purge_expired(batch_size)
+        finally:
+            ks.close_if_open()
+
+    def __iter_rows(self, sql, params=()):
+        """Streams query results using fetchmany(). Pending writes are flushed first."""
+        if self.__pending:
+            self.commit()
+        cursor = self.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                break
+            yield from rows
+
+    def __detect_codec_column(self):
+        """Detects files created before codec tags existed. They are not altered: other processes
+        running older code may share them."""
+        if "codec" not in self.get_column_names("data"):
+            self.__codec_col = "null"
+
+    def _ensure_chunk_table(self):
+        """Creates table "value_chunks" and the triggers that delete chunks of replaced/deleted
+        values, if not present yet."""
+        if "value_chunks" in self.get_table_names():
+            return
+        if self.__codec_col == "null":
+            raise RuntimeError("File '{}' has no codec column, convert it with migrate_keystore() "
+                               "first".format(self.filename))
+        with self.transaction(flag_immediate=True):
+            # Checks again under the write lock: another process may have just created it
+            if "value_chunks" in self.get_table_names():
+                return
+            self.execute("create table value_chunks (id integer primary key, "
+                         "blob_id integer not null, seq integer not null, data blob)")
+            self.execute("create unique index value_chunks_blob on value_chunks (blob_id, seq)")
+            self.execute("create trigger data_chunks_delete after delete on data "
+                         "when old.codec = {0} begin "
+                         "delete from value_chunks where blob_id = old.value; end".
+                         format(SER_CHUNKED))
+            # "insert or replace" does not fire delete triggers
+            self.execute("create trigger data_chunks_replace before insert on data begin "
+                         "delete from value_chunks where blob_id = "
+                         "(select value from data where key = new.key and codec = {0}); end".
+                         format(SER_CHUNKED))
+
+    def __ensure_ttl_column(self, flag_ttl):
+        """Detects or (if flag_ttl) adds the "expires" column and its index."""
+        if "expires" in self.get_column_names("data"):
+            self.__flag_ttl = True
+        elif flag_ttl:
+            self._check_writable()
+            with self.transaction(flag_immediate=True):
+                # Checks again under the write lock: another process may have just added it
+                if "expires" not in self.get_column_names("data"):
+                    self.execute("alter table data add column expires real")
+                    self.execute("create index data_expires on data (expires) "
+                                 "where expires is not null")
+            self.__flag_ttl = True
+
+    def __add_pending(self, rows):
+        """Adds (key, (encoded value, codec tag, expiry time)) rows to the pending writes; flushes if limits are reached."""
+        with self.__pending_lock:
+            now = time.monotonic()
+            if self.__pending_since is None:
+                self.__pending_since = now
+            self.__pending.update(rows)
+            if len(self.__pending) >= self.write_behind_entries or \
+                    (now-self.__pending_since)*1000 >= self.write_behind_ms:
+                self.commit()
+        if self.__flusher is None and self.__pending:
+            self.__flusher_stop.clear()
+            self.__flusher = threading.Thread(target=self.__flusher_main,
+                                              name="Keystore-write-behind", daemon=True)
+            self.__flusher.start()
+
+
+class _ValuesView(ValuesView):
+    def __iter__(self):
+        for _, value in self._mapping._iter_items():
+            yield value
+
+
+class _ItemsView(ItemsView):
+    def __iter__(self):
+        yield from self._mapping._iter_items()
+
+
+def _prefix_upper_bound(prefix):
+    """Returns smallest string greater than all strings starting with prefix, or None."""
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10ffff:
+            return prefix[:-1]+chr(last+1)
+        prefix = prefix[:-1]
+    return None
+
+
+class _ValueReader(io.RawIOBase):
+    """Reads value written through Keystore.open_value() chunk by chunk.
+
+    Args:
+        ks: Keystore
+        chunks: [(rowid, size), ...] in value_chunks table
+    """
+
+    def __init__(self, ks, chunks):
+        self.__ks = ks
+        self.__chunks = chunks
+        self.__index = 0
+        self.__offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.__index < len(self.__chunks) and \
+                self.__offset >= self.__chunks[self.__index][1]:
+            self.__index += 1
+            self.__offset = 0
+        if self.__index >= len(self.__chunks) or len(b) == 0:
+            return 0
+        rowid, size = self.__chunks[self.__index]
+        data = self.__ks._read_value_chunk(rowid, self.__offset, min(len(b), size-self.__offset))
+        n = len(data)
+        b[:n] = data
+        self.__offset += n
+        return n
+
+
+class _ValueWriter(io.RawIOBase):
+    """Writes value for Keystore.open_value(), value_chunk_size bytes per row.
+
+    Holds a write transaction from creation until close() (commits) or abort() (rolls back).
+    Exiting a with block by exception aborts.
+    """
+
+    def __init__(self, ks, key):
+        self.__ks = ks
+        self.__key = key
+        self.__buffer = bytearray()
+        self.__seq = 0
+        self.__tx = ks.transaction(flag_immediate=True)
+        self.__tx.__enter__()
+        try:
+            self.__blob_id = ks._new_value_blob_id()
+        except BaseException as e:
+            self.__abort(e)
+            raise
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        self.__buffer += b
+        size = self.__ks.value_chunk_size
+        if len(self.__buffer) >= size:
+            n = len(self.__buffer)//size*size
+            chunks = [bytes(self.__buffer[i:i+size]) for i in range(0, n, size)]
+            del self.__buffer[:n]
+            try:
+                self.__write_chunks(chunks)
+            except BaseException as e:
+                super().close()
+                self.__abort(e)
+                raise
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        try:
+            if self.__buffer:
+                self.__write_chunks([bytes(self.__buffer)])
+            self.__ks._set_chunked_value(self.__key, self.__blob_id)
+        except BaseException as e:
+            self.__abort(e)
+            raise
+        self.__tx.__exit__(None, None, None)
+
+    def abort(self):
+        """Closes discarding everything written"""
+        if not self.closed:
+            super().close()
+            self.__abort(RuntimeError("Value write aborted"))
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.abort()
+        else:
+            self.close()
+        return False
+
+    def __write_chunks(self, chunks):
+        self.__ks._write_value_chunks(self.__blob_id, self.__seq, chunks)
+        self.__seq += len(chunks)
+
+    def __abort(self, e):
+        try:
+            self.__tx.__exit__(type(e), e, None)
+        except BaseException:
+            pass
+
+
+def migrate_keystore(filename, dest=None):
+    """Converts a Keystore file to layout 2 (see Keystore).
+
+    Rows (including the chunks of values written through open_value()) are copied into a new
+    file, which then replaces the original (unless dest is given).
+    Numeric keys of layout 1 (including text keys that looked like numbers) become text.
+    Nobody should be using the file meanwhile.
+
+    Args:
+        filename: Keystore file
+        dest: (optional) name of the converted copy; filename is left untouched. **Must not
+              exist**
+
+    Returns:
+        number of rows copied
+    """
+    if dest is not None and os.path.exists(dest):
+        raise RuntimeError("File already exists: '{}'".format(dest))
+    tmpname = dest if dest is not None else filename+"-migrate"
+    if os.path.exists(tmpname):
+        os.remove(tmpname)
+    src = Keystore(filename, flag_read_only=True)
+    try:
+        columns = src.get_column_names("data")
+        flag_chunks = "value_chunks" in src.get_table_names()
+    finally:
+        src.close_if_open()
+    flag_ttl = "expires" in columns
+    ks = Keystore(tmpname, layout=2, flag_ttl=flag_ttl)
+    try:
+        if flag_chunks:
+            ks._ensure_chunk_table()
+    finally:
+        ks.close_if_open()
+
+    names = ["key", "value", "codec"]+(["expires"] if flag_ttl else [])
+    conn = sqlite3.connect(filename)
+    try:
+        conn.execute("attach database ? as dest", (tmpname,))
+        n = conn.execute("insert or replace into dest.data ({}) select {} from main.data".format(
+                         ", ".join(names), ", ".join(name if name in columns else "null"
+                                                     for name in names))).rowcount
+        if flag_chunks:
+            conn.execute("insert into dest.value_chunks (id, blob_id, seq, data) "
+                         "select id, blob_id, seq, data from main.value_chunks")
+        conn.commit()
+        conn.execute("detach database dest")
+    except BaseException:
+        conn.close()
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    conn.close()
+    if dest is None:
+        os.replace(tmpname, filename)
+    return n
+
+
+class _LRUCache(object):
+    """Least-recently-used cache bounded by number of entries and by approximate size in bytes."""
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.num_bytes = 0
+        # {key: (value, size, expiry time), ...}, least recently used first
+        self.__data = OrderedDict()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def get(self, key):
+        """Returns cached value or _MISSING"""
+        try:
+            value, _, expires = self.__data[key]
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+        if expires is not None and expires <= time.time():
+            self.discard(key)
+            self.misses += 1
+            return _MISSING
+        self.__data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size, expires=None):
+        self.discard(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self.__data[key] = (value, size, expires)
+        self.num_bytes += size
+        while len(self.__data) > self.max_entries or \
+                (self.max_bytes is not None and self.num_bytes > self.max_bytes):
+            _, (_, size_, _) = self.__data.popitem(last=False)
+            self.num_bytes -= size_
+
+    def discard(self, key):
+        item = self.__data.pop(key, None)
+        if item is not None:
+            self.num_bytes -= item[1]
+
+    def clear(self):
+        self.__data.clear()
+        self.num_bytes = 0
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.__data),
+                "bytes": self.num_bytes, "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes}
+
+
+@atexit.register
+def _flush_write_behind_stores():
+    for ks in list(_write_behind_stores):
+        try:
+            ks.close_if_open()
+        except Exception:
+            pass
@@ -1,56 +1,471 @@
-# Was going to use pickledb, but I don't trust it so far and I think I can come with a different solution
-
-
-# import pickledb
-#
-# __all__ = ["Keystore2"]
-#
-# class Keystore2(object):
-#     def __init__(self, filename):
-#         self.db = pickledb.
-#     def get(self, key, default=None):
-#         try:
-#             return self[key]
-#         except KeyError:
-#             pass
-#         return default
-#
-#     def __getitem__(self, key):
-#         conn = self.get_conn()
-#         cursor = conn.execute("select value from data where key = ?", (key,))
-#         __res = cursor.fetchone()
-#         if __res is None:
-#             print(f"KEYSTORE VAI RAISAR para '{key}")
-#             raise KeyError(f"Key not found: '{key}'")
-#
-#         _res = __res[0]
-#         res = self._unpickle(_res)
-#         print(f"KEYSTORE RETORNANDO '{res}' PARA '{key}'")
-#         return res
-#
-#     def __setitem__(self, key, value):
-#         n = self.execute("select count(*) from data where key = ?", (key,)).fetchone()[0]
-#         value_ = self._pickle(value)
-#         if n > 0:
-#             self.execute("update data set value = ? where key = ?", (value_, key))
-#         else:
-#             self.execute("insert into data values (?, ?)", (key, value_))
-#         # self.commit()
-#         return value
-#
-#
-#     # OVERRIDEN
-#
-#     def _create_schema(self, cursor):
-#         """Responsible for executing the CREATE TABLE statements"""
-#         conn = self.get_conn()
-#         conn.execute("create table data (key string not null primary key,"
-#                             "value text)")
-#         conn.execute("create index data_key on data (key)")
-#         self.commit()
-#
-#     def _pickle(self, obj):
-#         return pkl.dumps(obj)
-#
-#     def _unpickle(self, s):
-#         return pkl.loads(s)
\ No newline at end of file
+"""
+Log-structured key-value store: append-only record log + in-memory hash index.
+
+File layout (all integers little-endian):
+
+    header: magic (8 bytes) + generation (16 random bytes, renewed by compaction and clear())
+    record: crc32 (uint32), key length (uint32), value length (uint32), codec tag (uint8),
+            flags (uint8), key (utf-8), value (encoded by a ValueCodec)
+
+crc32 covers everything in the record after itself. A deletion is a record with the tombstone
+flag and empty value.
+
+The hint file ("<filename>.hint") holds a pickled snapshot of the index together with the log
+generation and size it corresponds to. It is written on close and after compaction; on opening,
+only records appended after the snapshot need to be scanned. A hint that does not match the log,
+or that came before a truncated tail, is deleted.
+"""
+
+from .valuecodecs import ValueCodec
+from collections.abc import MutableMapping
+import mmap
+import os
+import pickle as pkl
+import struct
+import threading
+import zlib
+
+
+__all__ = ["Keystore2"]
+
+
+_MAGIC = b"F312KS2\n"
+_HEADER_SIZE = len(_MAGIC)+16
+# crc32, key length, value length, codec tag, flags
+_REC = struct.Struct("<IIIBB")
+_TOMBSTONE = 1
+
+
+class Keystore2(MutableMapping):
+    """Persistent key-value store backed by an append-only log file.
+
+    Same mapping API as Keystore, for write-heavy workloads: a write appends one record to the
+    log (no B-tree maintenance), and a read is one dictionary lookup plus a slice of the
+    memory-mapped file. Overwritten and deleted records take space until compact() is run
+    (explicitly or automatically, see compact_ratio).
+
+    Keys must be strings. The whole index lives in memory. **Note** the file must not be opened
+    by more than one Keystore2 object (or process) at a time.
+
+    Args:
+        filename: log file name (created if it does not exist)
+        codec: ValueCodec instance used to encode values (defaults to highest-protocol pickle
+               without compression)
+        flag_fsync: commit() also calls os.fsync()
+        compact_ratio: compacts automatically once this fraction of the file is taken by dead
+                       records (None disables automatic compaction)
+        compact_min_bytes: no automatic compaction for files smaller than this
+        flag_background_compaction: automatic compaction runs in a separate thread, so that
+                                    reads and writes go on meanwhile
+    """
+
+    def __init__(self, filename, codec=None, flag_fsync=False, compact_ratio=0.5,
+                 compact_min_bytes=1 << 20, flag_background_compaction=True):
+        self.filename = filename
+        self.codec = codec if codec is not None else ValueCodec()
+        self.flag_fsync = flag_fsync
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.flag_background_compaction = flag_background_compaction
+        self.__lock = threading.RLock()
+        self.__file = None
+        self.__mm = None
+        self.__mapped = 0
+        self.__compaction = None
+        self.__compaction_error = None
+        # {key: (value offset, value length, codec tag, record size), ...}
+        self.__index = {}
+        # Bytes taken by overwritten/deleted records and tombstones
+        self.__dead = 0
+        # Log size, including data still in the write buffer
+        self.__size = 0
+        self.__generation = None
+        self.__open()
+
+    @property
+    def hint_filename(self):
+        return self.filename+".hint"
+
+    # # Mapping interface
+    #   =================
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        with self.__lock:
+            entry = self.__index.get(key)
+            if entry is None:
+                raise KeyError(f"Key not found: '{key}'")
+            return self.codec.decode(self.__read(entry), entry[2])
+
+    def __setitem__(self, key, value):
+        _check_key(key)
+        value_, codec = self.codec.encode(value)
+        with self.__lock:
+            self.__append(key, value_, codec)
+        self.__maybe_compact()
+
+    def __delitem__(self, key):
+        with self.__lock:
+            if key not in self.__index:
+                raise KeyError(f"Key not found: '{key}'")
+            self.__append(key, b"", 0, _TOMBSTONE)
+        self.__maybe_compact()
+
+    def __contains__(self, key):
+        return key in self.__index
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __iter__(self):
+        """Iterates over keys in key order (over a snapshot of the keys)"""
+        with self.__lock:
+            keys = sorted(self.__index)
+        return iter(keys)
+
+    def clear(self):
+        """Removes all keys, resetting the log to an empty file."""
+        self.__wait_compaction()
+        with self.__lock:
+            self.__close_files()
+            _write_header(self.filename)
+            self.__remove_hint()
+            self.__open()
+
+    def update(self, other=(), **kwargs):
+        """Same as dict.update(), but stores using set_many()."""
+        self.set_many(other)
+        if kwargs:
+            self.set_many(kwargs)
+
+    def scan_prefix(self, prefix):
+        """Generates (key, value) for keys starting with prefix, in key order."""
+        for key in self:
+            if key.startswith(prefix):
+                value = self.get(key, _MISSING)
+                if value is not _MISSING:
+                    yield key, value
+
+    def scan_range(self, lo=None, hi=None):
+        """Generates (key, value) for lo <= key < hi, in key order. lo/hi may be None (unbounded)
+        """
+        for key in self:
+            if (lo is None or key >= lo) and (hi is None or key < hi):
+                value = self.get(key, _MISSING)
+                if value is not _MISSING:
+                    yield key, value
+
+    # # Batch operations
+    #   ================
+
+    def set_many(self, items):
+        """Stores many key-value pairs.
+
+        Args:
+            items: mapping or iterable of (key, value) pairs
+
+        Returns:
+            number of pairs stored
+        """
+        if hasattr(items, "items"):
+            items = items.items()
+        rows = []
+        for key, value in items:
+            _check_key(key)
+            rows.append((key,)+self.codec.encode(value))
+        with self.__lock:
+            for row in rows:
+                self.__append(*row)
+        self.__maybe_compact()
+        return len(rows)
+
+    def get_many(self, keys):
+        """Returns {key: value, ...} containing only the keys that were found"""
+        ret = {}
+        with self.__lock:
+            for key in keys:
+                entry = self.__index.get(key)
+                if entry is not None:
+                    ret[key] = self.codec.decode(self.__read(entry), entry[2])
+        return ret
+
+    def delete_many(self, keys):
+        """Returns number of entries deleted"""
+        ret = 0
+        with self.__lock:
+            for key in keys:
+                if key in self.__index:
+                    self.__append(key, b"", 0, _TOMBSTONE)
+                    ret += 1
+        self.__maybe_compact()
+        return ret
+
+    # # Database-like interface
+    #   =======================
+
+    def commit(self):
+        """Hands buffered records to the operating system (and syncs them if flag_fsync)."""
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.flush()
+                if self.flag_fsync:
+                    os.fsync(self.__file.fileno())
+
+    def flush(self):
+        self.commit()
+
+    def close_if_open(self):
+        """Waits for compaction, writes the hint file and closes the log."""
+        self.__wait_compaction()
+        with self.__lock:
+            if self.__file is None:
+                return
+            self.commit()
+            self.__write_hint()
+            self.__close_files()
+
+    def delete(self):
+        """Closes and removes the log and hint files. **CAREFUL**"""
+        self.__wait_compaction()
+        with self.__lock:
+            self.__close_files()
+            for filename in (self.filename, self.hint_filename):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def get_stats(self):
+        """Returns {"keys", "file_bytes", "dead_bytes"}"""
+        with self.__lock:
+            return {"keys": len(self.__index), "file_bytes": self.__size,
+                    "dead_bytes": self.__dead}
+
+    # # Compaction
+    #   ==========
+
+    def compact(self, flag_wait=True):
+        """Rewrites the log keeping only live records.
+
+        Live records are copied in a separate thread; records appended meanwhile are carried over
+        before the new log replaces the old one.
+
+        Args:
+            flag_wait: waits for compaction to finish. If False, returns the compaction thread
+        """
+        with self.__lock:
+            if self.__file is None:
+                raise RuntimeError("Keystore2 '{}' is closed".format(self.filename))
+            thread = self.__compaction
+            if thread is None:
+                self.__file.flush()
+                self.__compaction_error = None
+                thread = self.__compaction = threading.Thread(
+                    target=self.__compact_main, args=(dict(self.__index), self.__size),
+                    name="Keystore2-compaction", daemon=True)
+                thread.start()
+        if not flag_wait:
+            return thread
+        thread.join()
+        if self.__compaction_error is not None:
+            raise self.__compaction_error
+
+    # # Internal gear
+    #   =============
+
+    def __open(self):
+        if not os.path.exists(self.filename) or os.path.getsize(self.filename) == 0:
+            _write_header(self.filename)
+        self.__file = open(self.filename, "r+b")
+        header = self.__file.read(_HEADER_SIZE)
+        if len(header) < _HEADER_SIZE or not header.startswith(_MAGIC):
+            self.__file.close()
+            self.__file = None
+            raise RuntimeError("'{}' is not a Keystore2 file".format(self.filename))
+        self.__generation = header[len(_MAGIC):]
+        self.__remap()
+
+        index, dead, pos = {}, 0, _HEADER_SIZE
+        hint = self.__read_hint()
+        if hint is not None:
+            index, dead, pos = hint["index"], hint["dead"], hint["size"]
+        else:
+            # A rejected hint may look valid again once the log has grown past its size
+            self.__remove_hint()
+        end, dead_ = _scan(self.__mm, pos, index)
+        self.__index, self.__dead = index, dead+dead_
+        if end < self.__mapped:
+            # Incomplete or corrupt tail, e.g., after a crash
+            self.__remove_hint()
+            self.__mm.close()
+            self.__file.truncate(end)
+            self.__remap()
+        self.__size = end
+        self.__file.seek(end)
+
+    def __close_files(self):
+        if self.__mm is not None:
+            self.__mm.close()
+            self.__mm, self.__mapped = None, 0
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __remap(self):
+        if self.__mm is not None:
+            self.__mm.close()
+        self.__mm = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__mapped = len(self.__mm)
+
+    def __read(self, entry):
+        offset, length = entry[0], entry[1]
+        if offset+length > self.__mapped:
+            self.__file.flush()
+            self.__remap()
+        return self.__mm[offset:offset+length]
+
+    def __append(self, key, value_, codec, flags=0):
+        if self.__file is None:
+            raise RuntimeError("Keystore2 '{}' is closed".format(self.filename))
+        key_ = key.encode("utf8")
+        header = _REC.pack(0, len(key_), len(value_), codec, flags)
+        crc = zlib.crc32(value_, zlib.crc32(key_, zlib.crc32(header[4:])))
+        self.__file.write(struct.pack("<I", crc)+header[4:]+key_)
+        self.__file.write(value_)
+        size = _REC.size+len(key_)+len(value_)
+        old = self.__index.pop(key, None)
+        if old is not None:
+            self.__dead += old[3]
+        if flags & _TOMBSTONE:
+            self.__dead += size
+        else:
+            self.__index[key] = (self.__size+_REC.size+len(key_), len(value_), codec, size)
+        self.__size += size
+
+    def __maybe_compact(self):
+        if self.compact_ratio is None or self.__compaction is not None or \
+                self.__size < self.compact_min_bytes or \
+                self.__dead <= self.compact_ratio*self.__size:
+            return
+        self.compact(flag_wait=not self.flag_background_compaction)
+
+    def __wait_compaction(self):
+        thread = self.__compaction
+        if thread is not None:
+            thread.join()
+
+    def __compact_main(self, snapshot, size):
+        tmpname = self.filename+".compact"
+        generation = os.urandom(16)
+        try:
+            with open(self.filename, "rb") as f, open(tmpname, "wb") as g:
+                g.write(_MAGIC+generation)
+                pos, index = _HEADER_SIZE, {}
+                # Records before size are never modified, so they are copied without the lock
+                src = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    for key, (offset, length, codec, recsize) in snapshot.items():
+                        start = offset+length-recsize
+                        g.write(src[start:start+recsize])
+                        index[key] = (pos+recsize-length, length, codec, recsize)
+                        pos += recsize
+                finally:
+                    src.close()
+
+                with self.__lock:
+                    self.__file.flush()
+                    f.seek(size)
+                    tail = f.read(self.__size-size)
+                    g.write(tail)
+                    _, dead = _scan(tail, 0, index, pos)
+                    g.flush()
+                    os.fsync(g.fileno())
+                    g.close()
+                    self.__close_files()
+                    os.replace(tmpname, self.filename)
+                    self.__file = open(self.filename, "r+b")
+                    self.__file.seek(0, os.SEEK_END)
+                    self.__remap()
+                    self.__index, self.__dead = index, dead
+                    self.__size, self.__generation = pos+len(tail), generation
+                    self.__write_hint()
+        except BaseException as e:
+            self.__compaction_error = e
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            with self.__lock:
+                if self.__file is None:
+                    # Failed after closing the old log: reopens whatever is in place
+                    self.__open()
+        finally:
+            self.__compaction = None
+
+    def __read_hint(self):
+        """Returns hint dict if it matches the log, otherwise None"""
+        try:
+            with open(self.hint_filename, "rb") as file:
+                hint = pkl.load(file)
+        except (OSError, EOFError, pkl.UnpicklingError):
+            return None
+        if hint.get("generation") != self.__generation or hint.get("size", 0) > self.__mapped:
+            return None
+        return hint
+
+    def __remove_hint(self):
+        if os.path.exists(self.hint_filename):
+            os.remove(self.hint_filename)
+
+    def __write_hint(self):
+        tmpname = self.hint_filename+".tmp"
+        with open(tmpname, "wb") as file:
+            pkl.dump({"generation": self.__generation, "size": self.__size, "dead": self.__dead,
+                      "index": self.__index}, file, protocol=pkl.HIGHEST_PROTOCOL)
+        os.replace(tmpname, self.hint_filename)
+
+
+# Returned by get() in scans when key has been deleted meanwhile
+_MISSING = object()
+
+
+def _check_key(key):
+    if not isinstance(key, str):
+        raise TypeError("Keystore2 keys must be str, not {}".format(type(key).__name__))
+
+
+def _write_header(filename):
+    with open(filename, "wb") as file:
+        file.write(_MAGIC+os.urandom(16))
+
+
+def _scan(buf, pos, index, base=0):
+    """Replays records in buf, starting at pos, into index.
+
+    Args:
+        buf: bytes-like containing records
+        pos: offset of first record in buf
+        index: {key: (value offset, value length, codec tag, record size), ...} (modified)
+        base: offset of buf[0] in the log file
+
+    Returns:
+        (offset after the last complete and valid record, bytes taken by dead records)
+    """
+    dead, end = 0, len(buf)
+    while pos+_REC.size <= end:
+        crc, key_len, value_len, codec, flags = _REC.unpack_from(buf, pos)
+        size = _REC.size+key_len+value_len
+        if pos+size > end or zlib.crc32(buf[pos+4:pos+size]) != crc:
+            break
+        key_pos = pos+_REC.size
+        key = bytes(buf[key_pos:key_pos+key_len]).decode("utf8")
+        old = index.pop(key, None)
+        if old is not None:
+            dead += old[3]
+        if flags & _TOMBSTONE:
+            dead += size
+        else:
+            index[key] = (base+key_pos+key_len, value_len, codec, size)
+        pos += size
+    return pos, dead
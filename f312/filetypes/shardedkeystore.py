@@ -0,0 +1,189 @@
+from .keystore import Keystore
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import operator
+import os
+import zlib
+
+
+__all__ = ["ShardedKeystore"]
+
+
+class ShardedKeystore(MutableMapping):
+    """Key-value store spread over several Keystore files by stable hash of the key.
+
+    Each shard is a separate SQLite file with its own lock, so that writers of different shards do
+    not serialize on each other.
+
+    Args:
+        filename: base filename. Shard i is stored as "<root>-<i>.<ext>", e.g.
+                  "store.sqlite" --> "store-000.sqlite", "store-001.sqlite", ...
+        num_shards: number of shards. **Must** be the same every time the store is opened
+        **kwargs: passed to each Keystore
+    """
+
+    def __init__(self, filename, num_shards=8, **kwargs):
+        if num_shards < 1:
+            raise ValueError("num_shards must be at least 1")
+        self.filename = filename
+        self.num_shards = num_shards
+        self.keystore_kwargs = kwargs
+        self.shards = [Keystore(fn, **kwargs) for fn in self.get_shard_filenames()]
+
+    def get_shard_filenames(self):
+        root, ext = os.path.splitext(self.filename)
+        return ["{}-{:03d}{}".format(root, i, ext) for i in range(self.num_shards)]
+
+    def get_shard_index(self, key):
+        """Returns index of shard holding key. Stable across processes and interpreter runs."""
+        if isinstance(key, str):
+            key_ = key.encode("utf8")
+        elif isinstance(key, bytes):
+            key_ = key
+        else:
+            key_ = repr(key).encode("utf8")
+        return zlib.crc32(key_) % self.num_shards
+
+    def get_shard(self, key):
+        return self.shards[self.get_shard_index(key)]
+
+    # # Mapping interface
+    #   =================
+
+    def get(self, key, default=None):
+        return self.get_shard(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self.get_shard(key)[key]
+
+    def __setitem__(self, key, value):
+        self.get_shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self.get_shard(key)[key]
+
+    def __contains__(self, key):
+        return key in self.get_shard(key)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __iter__(self):
+        """Iterates over keys shard by shard (**not** in global key order)."""
+        for shard in self.shards:
+            yield from shard
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def update(self, other=(), **kwargs):
+        self.set_many(other)
+        if kwargs:
+            self.set_many(kwargs)
+
+    # # Batch operations (fan out per shard)
+    #   ====================================
+
+    def set_many(self, items):
+        """Stores many key-value pairs, one transaction per shard involved.
+
+        Returns:
+            number of pairs stored
+        """
+        return sum(self.shards[i].set_many(items_) for i, items_ in self.__split(items).items())
+
+    def get_many(self, keys):
+        """Returns {key: value, ...} containing only the keys that were found"""
+        ret = {}
+        for i, keys_ in self.__split_keys(keys).items():
+            ret.update(self.shards[i].get_many(keys_))
+        return ret
+
+    def delete_many(self, keys):
+        """Returns number of entries deleted"""
+        return sum(self.shards[i].delete_many(keys_)
+                   for i, keys_ in self.__split_keys(keys).items())
+
+    def bulk_load(self, items, max_workers=None):
+        """Loads many key-value pairs filling all shards in parallel using a process pool.
+
+        Args:
+            items: mapping or iterable of (key, value) pairs. Keys and values must be picklable
+            max_workers: passed to concurrent.futures.ProcessPoolExecutor (defaults to the
+                         number of processors)
+
+        Returns:
+            number of pairs stored
+        """
+        # Pending writes in this process would overwrite the bulk-loaded values later on
+        self.commit()
+        groups = self.__split(items)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_load_shard, self.shards[i].filename, items_,
+                                       self.keystore_kwargs)
+                       for i, items_ in groups.items()]
+            ret = sum(future.result() for future in futures)
+        for shard in self.shards:
+            shard.clear_cache()
+        return ret
+
+    def scan_prefix(self, prefix):
+        """Generates (key, value) for keys starting with prefix, in key order across all shards."""
+        return heapq.merge(*[shard.scan_prefix(prefix) for shard in self.shards],
+                           key=operator.itemgetter(0))
+
+    def scan_range(self, lo=None, hi=None):
+        """Generates (key, value) for lo <= key < hi, in key order across all shards."""
+        return heapq.merge(*[shard.scan_range(lo, hi) for shard in self.shards],
+                           key=operator.itemgetter(0))
+
+    # # Database-like interface
+    #   =======================
+
+    def commit(self):
+        for shard in self.shards:
+            shard.commit()
+
+    def flush(self):
+        self.commit()
+
+    def close_if_open(self):
+        for shard in self.shards:
+            shard.close_if_open()
+
+    def delete(self):
+        """Removes all shard files. **CAREFUL**"""
+        for shard in self.shards:
+            shard.delete()
+
+    # # Internal gear
+    #   =============
+
+    def __split(self, items):
+        """Returns {shard index: [(key, value), ...], ...}"""
+        if hasattr(items, "items"):
+            items = items.items()
+        ret = {}
+        for key, value in items:
+            ret.setdefault(self.get_shard_index(key), []).append((key, value))
+        return ret
+
+    def __split_keys(self, keys):
+        """Returns {shard index: [key, ...], ...}"""
+        ret = {}
+        for key in keys:
+            ret.setdefault(self.get_shard_index(key), []).append(key)
+        return ret
+
+
+def _load_shard(filename, items, kwargs):
+    """Worker for ShardedKeystore.bulk_load(), runs in a separate process."""
+    ks = Keystore(filename, **kwargs)
+    try:
+        ret = ks.set_many(items)
+        ks.commit()
+        return ret
+    finally:
+        ks.close_if_open()
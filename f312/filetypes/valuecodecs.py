@@ -0,0 +1,122 @@
+"""
+Value codecs: conversion of Python objects to bytes (and back) with optional compression.
+
+Every encoded value comes with an integer tag identifying how it was encoded, so that a store can
+hold values encoded in different ways, and decoding does not depend on the current codec settings.
+The tag is composed as ``serializer+16*compression``, with the constants below.
+"""
+
+import pickle as pkl
+import zlib
+import lzma
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ["ValueCodec"]
+
+
+# Serializers
+# Pickle with default protocol (values written before codec tags existed)
+SER_PICKLE_LEGACY = 0
+# bytes stored as they are
+SER_RAW = 1
+# Pickle with highest protocol
+SER_PICKLE = 2
+# MessagePack (requires package msgpack)
+SER_MSGPACK = 3
+# Raw bytes kept outside the value column, in chunks (see Keystore.open_value()); not handled by
+# ValueCodec
+SER_CHUNKED = 15
+
+# Compressions
+COMPR_NONE = 0
+COMPR_ZLIB = 1
+COMPR_LZMA = 2
+
+_SERIALIZERS = {"pickle": SER_PICKLE, "msgpack": SER_MSGPACK}
+_COMPRESSIONS = {None: COMPR_NONE, "zlib": COMPR_ZLIB, "lzma": COMPR_LZMA}
+
+
+class ValueCodec(object):
+    """
+    Encodes/decodes values
+
+    Args:
+        serializer: "pickle" or "msgpack". Values that msgpack cannot handle fall back to pickle.
+                    **Note** msgpack does not round-trip every type exactly (e.g. tuples come back
+                    as lists)
+        compression: None, "zlib" or "lzma"
+        compress_threshold: serialized values smaller than this (bytes) are not compressed.
+                            Compression is also dropped if it does not reduce the size
+        flag_raw_bytes: stores bytes/bytearray values as they are, without serialization
+    """
+
+    def __init__(self, serializer="pickle", compression=None, compress_threshold=1024,
+                 flag_raw_bytes=True):
+        if serializer not in _SERIALIZERS:
+            raise ValueError("Invalid serializer: '{}'".format(serializer))
+        if serializer == "msgpack" and msgpack is None:
+            raise RuntimeError("Serializer 'msgpack' requires package msgpack")
+        if compression not in _COMPRESSIONS:
+            raise ValueError("Invalid compression: '{}'".format(compression))
+        self.serializer = serializer
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.flag_raw_bytes = flag_raw_bytes
+
+    def encode(self, value):
+        """Returns (data, tag), data being bytes."""
+        if self.flag_raw_bytes and isinstance(value, (bytes, bytearray)):
+            ser, data = SER_RAW, bytes(value)
+        else:
+            ser, data = _SERIALIZERS[self.serializer], None
+            if ser == SER_MSGPACK:
+                try:
+                    data = msgpack.packb(value, use_bin_type=True)
+                except (TypeError, ValueError, OverflowError):
+                    ser = SER_PICKLE
+            if data is None:
+                data = pkl.dumps(value, protocol=pkl.HIGHEST_PROTOCOL)
+
+        compr = _COMPRESSIONS[self.compression]
+        if compr != COMPR_NONE and len(data) >= self.compress_threshold:
+            compressed = _compress(data, compr)
+            if len(compressed) < len(data):
+                return compressed, ser+16*compr
+        return data, ser
+
+    def decode(self, data, tag):
+        """Reverse of encode(). tag None is taken as SER_PICKLE_LEGACY."""
+        if tag is None:
+            tag = SER_PICKLE_LEGACY
+        ser, compr = tag % 16, tag // 16
+        if compr != COMPR_NONE:
+            data = _decompress(data, compr)
+        if ser == SER_RAW:
+            return bytes(data)
+        if ser in (SER_PICKLE, SER_PICKLE_LEGACY):
+            return pkl.loads(data)
+        if ser == SER_MSGPACK:
+            if msgpack is None:
+                raise RuntimeError("Value was encoded with msgpack, which is not installed")
+            return msgpack.unpackb(data, raw=False)
+        raise ValueError("Invalid codec tag: {}".format(tag))
+
+
+def _compress(data, compr):
+    if compr == COMPR_ZLIB:
+        return zlib.compress(data)
+    if compr == COMPR_LZMA:
+        return lzma.compress(data)
+    raise ValueError("Invalid compression: {}".format(compr))
+
+
+def _decompress(data, compr):
+    if compr == COMPR_ZLIB:
+        return zlib.decompress(data)
+    if compr == COMPR_LZMA:
+        return lzma.decompress(data)
+    raise ValueError("Invalid compression: {}".format(compr))
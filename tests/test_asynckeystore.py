@@ -0,0 +1,43 @@
+import asyncio
+import os
+import f312
+
+
+def test_AsyncKeystore(tmpdir):
+    os.chdir(str(tmpdir))
+
+    async def main():
+        async with f312.AsyncKeystore("async.sqlite", num_readers=2) as aks:
+            await asyncio.gather(*[aks.set("k{}".format(i), i) for i in range(100)])
+            assert await aks.get("k99") == 99
+            assert await aks.get_many(["k0", "x"]) == {"k0": 0}
+            await aks.delete("k0")
+            assert not await aks.contains("k0")
+            try:
+                await aks.delete("k0")
+                assert False
+            except KeyError:
+                pass
+            assert await aks.delete_many(["k1", "k2"]) == 2
+
+    asyncio.run(main())
+    assert len(f312.Keystore("async.sqlite")) == 97
+
+
+def test_AsyncKeystore_failing_op(tmpdir):
+    os.chdir(str(tmpdir))
+
+    def fails_halfway(ks):
+        ks["half"] = 1
+        raise ValueError("fails halfway")
+
+    async def main():
+        async with f312.AsyncKeystore("async.sqlite") as aks:
+            results = await asyncio.gather(aks.set("a", 1),
+                                           aks._AsyncKeystore__write(fails_halfway),
+                                           aks.set("b", 2), return_exceptions=True)
+            assert isinstance(results[1], ValueError)
+            assert await aks.get("a") == 1 and await aks.get("b") == 2
+            assert not await aks.contains("half")
+
+    asyncio.run(main())
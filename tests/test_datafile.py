@@ -0,0 +1,131 @@
+import os
+import struct
+import time
+import f312
+
+
+class _Table(f312.DataFile):
+    """Header line then one number per line"""
+    num_loads = 0
+
+    def __init__(self):
+        f312.DataFile.__init__(self)
+        self.title = None
+        self.values = []
+
+    def _do_load_header(self, filename):
+        with open(filename) as file:
+            self.title = file.readline().strip()
+
+    def _do_load(self, filename):
+        _Table.num_loads += 1
+        with open(filename) as file:
+            self.title = file.readline().strip()
+            self.values.extend(float(line) for line in file)
+
+    def _do_save_as(self, filename):
+        with open(filename, "w") as file:
+            file.write("\n".join([self.title]+[str(x) for x in self.values]))
+
+
+class _Doubles(f312.DataFile):
+    """Array of float64"""
+    flag_txt = False
+
+    def __init__(self):
+        f312.DataFile.__init__(self)
+        self.values = None
+
+    def _do_load_buffer(self, buf):
+        self.values = buf.cast("d")
+
+
+def test_lazy_load(tmpdir):
+    os.chdir(str(tmpdir))
+    with open("table.txt", "w") as file:
+        file.write("title\n1\n2\n")
+    f = _Table()
+    f.load("table.txt", flag_lazy=True)
+    assert f.title == "title" and f.filename == "table.txt"
+    assert f.flag_lazy_pending and _Table.num_loads == 0
+    assert f.values == [1., 2.] and not f.flag_lazy_pending and _Table.num_loads == 1
+
+    f = _Table()
+    f.load("table.txt", flag_lazy=True)
+    time.sleep(0.01)
+    with open("table.txt", "a") as file:
+        file.write("3\n")
+    try:
+        f.values
+        assert False
+    except RuntimeError:
+        pass
+
+    f = _Table()
+    f.load("table.txt")
+    assert f.values == [1., 2., 3.] and not f.flag_lazy_pending
+    try:
+        f.nonexistent
+        assert False
+    except AttributeError:
+        pass
+
+
+def test_load_buffer(tmpdir):
+    os.chdir(str(tmpdir))
+    with open("doubles.bin", "wb") as file:
+        file.write(struct.pack("<3d", 1., 2., 3.))
+    f = _Doubles()
+    f.load("doubles.bin")
+    assert list(f.values) == [1., 2., 3.] and f.values.readonly
+    values = f.values
+    f.release_buffer()
+    # Still usable: mapping is kept by the view built on it
+    assert values[2] == 3.
+    del values, f.values
+    f.release_buffer()
+
+
+class _Counter(f312.DataFile):
+    """Binary file; counts bytes of each value"""
+    flag_txt = False
+    io_chunk_size = 7
+
+    def __init__(self):
+        f312.DataFile.__init__(self)
+        self.counts = [0]*256
+
+    def _iter_load_chunks(self):
+        while True:
+            chunk = yield
+            if not chunk:
+                break
+            for x in chunk:
+                self.counts[x] += 1
+
+    def _iter_save_chunks(self):
+        for x, n in enumerate(self.counts):
+            if n == 1000:
+                raise ValueError("Too many")
+            yield bytes([x])*n
+
+
+def test_chunks_atomic_save(tmpdir):
+    os.chdir(str(tmpdir))
+    f = _Counter()
+    f.counts[65], f.counts[66] = 10, 5
+    f.save_as("counts.bin")
+    with open("counts.bin", "rb") as file:
+        assert file.read() == b"A"*10+b"B"*5
+    g = _Counter()
+    g.load("counts.bin")
+    assert g.counts == f.counts
+
+    # Failed save leaves destination untouched and no temporary file behind
+    f.counts[67] = 1000
+    try:
+        f.save_as("counts.bin")
+        assert False
+    except ValueError:
+        pass
+    assert os.listdir(".") == ["counts.bin"] and os.path.getsize("counts.bin") == 15
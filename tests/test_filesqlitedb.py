@@ -0,0 +1,220 @@
+import os
+import sqlite3
+import threading
+import f312
+
+
+class _DB(f312.FileSQLiteDB):
+    def _create_schema(self, cursor):
+        cursor.execute("create table t (x integer)")
+
+
+def test_thread_local(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("tl.sqlite", flag_thread_local=True)
+    db.execute("insert into t values (1)")
+    db.commit()
+    conns, results = [], []
+
+    def worker():
+        conns.append(db.get_conn())
+        results.append(db.execute("select count(*) from t").fetchone()[0])
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [1, 1, 1] and len(set(map(id, conns))) == 3
+    # Connections of finished threads are closed
+    for conn in conns:
+        try:
+            conn.execute("select 1")
+            assert False
+        except sqlite3.ProgrammingError:
+            pass
+    db.close_if_open()
+    assert db.execute("select count(*) from t").fetchone()[0] == 1
+
+
+def test_read_pool(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("pool.sqlite", read_pool_size=2)
+    with db.read_conn() as conn1:
+        with db.read_conn() as conn2:
+            assert conn1 is not conn2
+            try:
+                db.checkout_read_conn(timeout=0.01)
+                assert False
+            except RuntimeError:
+                pass
+    with db.read_conn() as conn3:
+        assert conn3 in (conn1, conn2)
+        assert conn3.execute("select count(*) from t").fetchone()[0] == 0
+    db.close_if_open()
+
+
+def test_pragma_profile(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("wal.sqlite", pragma_profile="fast-wal", pragmas={"cache_size": -1000})
+    pragmas = db.get_pragmas()
+    assert pragmas["journal_mode"] == "wal" and pragmas["synchronous"] == 1
+    assert pragmas["cache_size"] == -1000 and pragmas["temp_store"] == 2
+    try:
+        _DB("x.sqlite", pragma_profile="turbo")
+        assert False
+    except ValueError:
+        pass
+
+
+def test_transaction_savepoint(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("tx.sqlite")
+
+    def count():
+        return db.execute("select count(*) from t").fetchone()[0]
+
+    with db.transaction():
+        db.execute("insert into t values (1)")
+        db.commit()  # deferred
+        try:
+            with db.savepoint():
+                db.execute("insert into t values (2)")
+                raise ValueError()
+        except ValueError:
+            pass
+        assert count() == 1
+    try:
+        with db.transaction():
+            db.execute("insert into t values (3)")
+            raise ValueError()
+    except ValueError:
+        pass
+    db.close_if_open()
+    assert count() == 1
+
+
+def test_backup_vacuum_into(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("src.sqlite")
+    db.executemany("insert into t values (?)", [(i,) for i in range(1000)])
+    db.commit()
+    progress = []
+    db.backup("backup.sqlite", pages=1, progress=lambda remaining, total: progress.append(remaining))
+    assert len(progress) > 1 and progress[-1] == 0
+    db.vacuum_into("vacuum.sqlite")
+    for filename in ("backup.sqlite", "vacuum.sqlite"):
+        assert _DB(filename).execute("select count(*) from t").fetchone()[0] == 1000
+    assert db.execute("select count(*) from t").fetchone()[0] == 1000
+
+
+def test_instrumentation(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("stats.sqlite")
+    assert db.get_query_stats() is None
+    slow = []
+    db.enable_instrumentation(slow_threshold=0., slow_callback=lambda *args: slow.append(args))
+    db.executemany("insert into t values (?)", [(i,) for i in range(10)])
+    sql = "select x from t where x < ?"
+    for _ in range(3):
+        assert len(db.execute(sql, (5,)).fetchall()) == 5
+    stats = db.get_query_stats()
+    assert stats[sql]["count"] == 3 and stats[sql]["rows"] == 15
+    assert stats[sql]["p50"] <= stats[sql]["max"]
+    assert len(slow) == 4 and db.get_slow_queries()[-1]["plan"]
+    db.executemany("insert into t values (?)", ((i,) for i in range(3)))
+    assert not any(p.startswith("(cannot explain") for p in db.get_slow_queries()[-1]["plan"])
+    assert db.execute("select count(*) from t").fetchone()[0] == 13
+    db.reset_query_stats()
+    assert db.get_query_stats() == {}
+
+
+def test_schema_cache(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("schema.sqlite")
+    assert db.get_table_names() == ["t"] and db.get_column_names("t") == ["x"]
+    db.execute("alter table t add column y text")
+    db.execute("create table u (z integer)")
+    assert db.get_column_names("t") == ["x", "y"]
+    assert sorted(db.get_table_names()) == ["t", "u"]
+    try:
+        db.get_table_info("missing")
+        assert False
+    except RuntimeError:
+        pass
+    cache = {}
+    assert list(f312.get_table_info(db.get_conn(), "u", cache=cache)) == ["z"]
+    assert list(f312.get_table_info(db.get_conn(), "u", cache=cache)) == ["z"]
+
+
+def test_iter_rows_fetch_columns(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("columns.sqlite")
+    db.execute("alter table t add column y text")
+    db.executemany("insert into t values (?, ?)", [(i, str(i)) for i in range(2500)])
+    rows = list(db.iter_rows("select x, y from t where x < ?", (3,), chunk_size=2,
+                             row_factory=None))
+    assert rows == [(0, "0"), (1, "1"), (2, "2")]
+    assert next(db.iter_rows("select x from t"))["x"] == 0
+    try:
+        import numpy as np
+    except ImportError:
+        return
+    columns = db.fetch_columns("select x, y, x/2.0 as z from t")
+    assert columns["x"].dtype == np.int64 and columns["z"].dtype == np.float64
+    assert columns["y"].dtype == object and len(columns["x"]) == 2500
+    assert columns["x"].sum() == sum(range(2500))
+
+    # Types that only show up after the first chunk
+    db.execute("create table u (a, b)")
+    db.executemany("insert into u values (?, ?)", [(i, i) for i in range(20000)])
+    db.execute("insert into u values (1.5, null)")
+    columns = db.fetch_columns("select a, b from u")
+    assert columns["a"].dtype == np.float64 and columns["a"][-1] == 1.5
+    assert columns["b"].dtype == np.float64 and np.isnan(columns["b"][-1])
+    assert columns["b"][19999] == 19999
+    db.execute("insert into u values ('x', 0)")
+    assert db.fetch_columns("select a from u")["a"][-1] == "x"
+    assert len(db.fetch_columns("select a from u where 0")["a"]) == 0
+
+
+def test_bulk_insert_export(tmpdir):
+    os.chdir(str(tmpdir))
+    db = _DB("bulk.sqlite")
+    db.execute("alter table t add column y text")
+    db.execute("create index t_y on t (y)")
+    db.commit()
+    stats = db.bulk_insert("t", ((i, str(i)) for i in range(1000)), chunk_size=300,
+                           flag_rebuild_indexes=True)
+    assert stats["rows"] == 1000 and stats["rows_per_second"] > 0
+    assert db.execute("select count(*) from sqlite_master where name = 't_y'").fetchone()[0] == 1
+    assert db.bulk_export("t", "t.csv")["rows"] == 1000
+    db2 = _DB("bulk2.sqlite")
+    db2.execute("alter table t add column y text")
+    assert db2.bulk_insert("t", "t.csv")["rows"] == 1000
+    chunks = []
+    db2.bulk_export("t", chunks.append, columns=["y"], chunk_size=400)
+    assert [len(chunk) for chunk in chunks] == [400, 400, 200] and chunks[0][0] == ("0",)
+    assert db.get_pragmas(["synchronous"])["synchronous"] == 2
+    open("empty.csv", "w").close()
+    try:
+        db2.bulk_insert("t", "empty.csv")
+        assert False
+    except RuntimeError:
+        pass
+    assert db2.bulk_insert("t", "empty.csv", columns=["x", "y"])["rows"] == 0
+
+    # synchronous = off only in WAL mode, and only when asked for
+    def rows(db, seen):
+        seen.append(db.get_pragmas(["synchronous"])["synchronous"])
+        yield (1, "1")
+
+    for i, (journal_mode, flag_bulk_pragmas, expected) in enumerate(
+            (("delete", True, 2), ("wal", False, 2), ("wal", True, 0))):
+        db3 = _DB("bulk3-{}.sqlite".format(i), pragmas={"journal_mode": journal_mode,
+                                                        "synchronous": "full"})
+        db3.execute("alter table t add column y text")
+        seen = []
+        db3.bulk_insert("t", rows(db3, seen), flag_bulk_pragmas=flag_bulk_pragmas)
+        assert seen == [expected]
+        db3.close_if_open()
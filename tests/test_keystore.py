@@ -1,4 +1,8 @@
+import multiprocessing
 import os
+import pickle
+import sqlite3
+import time
 import f312
 
 
@@ -11,3 +15,377 @@ def test_Awayokbleinawtostaygetipurionofoknahaitmakemyday(tmpdir):
     assert fkl[key] == value
     fkl[key] = "fok"
     assert fkl[key] == "fok"
+
+
+def test_batch(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("batch.sqlite")
+    ks["a"] = 0
+    assert ks.set_many({"a": 1, "b": [2], "0012": "c"}) == 3
+    assert ks.get_many(["a", "b", "0012", "missing"]) == {"a": 1, "b": [2], "0012": "c"}
+    assert ks.delete_many(["a", "missing"]) == 1
+    assert ks.get("a") is None
+    assert ks["b"] == [2]
+
+
+def test_write_behind(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("wb.sqlite", flag_write_behind=True, write_behind_entries=3,
+                       write_behind_ms=1e6)
+    ks["a"] = 1
+    ks.set_many({"b": 2})
+    assert ks["a"] == 1 and ks.get_many(["a", "b"]) == {"a": 1, "b": 2}
+    assert f312.Keystore("wb.sqlite").get("a") is None
+    ks["c"] = 3
+    assert f312.Keystore("wb.sqlite").get_many(["a", "b", "c"]) == {"a": 1, "b": 2, "c": 3}
+    ks["d"] = 4
+    ks.close_if_open()
+    assert f312.Keystore("wb.sqlite")["d"] == 4
+
+    # Idle store is flushed once the oldest pending write is write_behind_ms old
+    ks = f312.Keystore("wb.sqlite", flag_write_behind=True, write_behind_ms=10)
+    ks["e"] = 5
+    t = time.monotonic()
+    while f312.Keystore("wb.sqlite").get("e") is None:
+        assert time.monotonic()-t < 5
+        time.sleep(0.01)
+    assert ks["e"] == 5
+    ks.close_if_open()
+
+
+class _FlushedOnLookup(dict):
+    """Pending writes that the background flusher writes out right as they are looked up"""
+
+    def __init__(self, ks, items):
+        super().__init__(items)
+        self.ks = ks
+        self.writer = f312.Keystore(ks.filename)
+
+    def __flush(self):
+        self.writer._Keystore__write_pending_of(self.ks)
+
+    def __contains__(self, key):
+        ret = dict.__contains__(self, key)
+        self.__flush()
+        return ret
+
+    def get(self, key, default=None):
+        self.__flush()
+        return dict.get(self, key, default)
+
+
+def test_write_behind_flush_race(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("race.sqlite", flag_write_behind=True, write_behind_ms=1e6)
+    ks["a"] = b"1"
+    ks._Keystore__pending = _FlushedOnLookup(ks, ks._Keystore__pending)
+    for read in (lambda: ks["a"], lambda: ks.get_many(["a"])["a"],
+                 lambda: "a" in ks and b"1", lambda: ks.open_value("a").read()):
+        ks["a"] = b"1"
+        assert read() == b"1"
+    ks._Keystore__pending.writer.close_if_open()
+    ks.close_if_open()
+
+
+def test_read_cache(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("cache.sqlite", cache_entries=2)
+    ks.set_many({"a": 1, "b": 2, "c": 3})
+    assert ks["a"] == 1 and ks["a"] == 1
+    assert ks.get_many(["a", "b", "c"]) == {"a": 1, "b": 2, "c": 3}
+    ks["c"] = 30
+    assert ks["c"] == 30
+    stats = ks.get_cache_stats()
+    assert stats["hits"] == 2 and stats["misses"] == 4 and stats["entries"] == 2
+
+    # Values read inside a transaction that rolls back must not be cached
+    for get in (lambda: ks["a"], lambda: ks.get_many(["a"])["a"]):
+        ks["a"] = 1
+        try:
+            with ks.transaction():
+                ks["a"] = 2
+                assert get() == 2
+                raise ZeroDivisionError()
+        except ZeroDivisionError:
+            pass
+        assert ks["a"] == 1
+
+    # Per-thread connections would fill the shared cache with values of other transactions
+    try:
+        f312.Keystore("cache.sqlite", cache_entries=2, flag_thread_local=True)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_codecs(tmpdir):
+    os.chdir(str(tmpdir))
+    conn = sqlite3.connect("legacy.sqlite")
+    conn.execute("create table data (key string not null primary key, value text)")
+    conn.execute("insert into data values (?, ?)", ("old", pickle.dumps([1, 2])))
+    conn.commit()
+    conn.close()
+    codec = f312.ValueCodec(compression="zlib", compress_threshold=100)
+    ks = f312.Keystore("legacy.sqlite", codec=codec)
+    assert ks["old"] == [1, 2]
+    # Legacy file is left as it is, for older code sharing it; values are written as plain pickle
+    ks["new"] = [3]
+    ks.close_if_open()
+    conn = sqlite3.connect("legacy.sqlite")
+    conn.execute("insert into data values (?, ?)", ("older", pickle.dumps(0)))
+    assert pickle.loads(conn.execute("select value from data where key = 'new'").fetchone()[0]) \
+           == [3]
+    conn.commit()
+    conn.close()
+    f312.migrate_keystore("legacy.sqlite")
+    ks = f312.Keystore("legacy.sqlite", codec=codec)
+    assert ks.get_many(["old", "new", "older"]) == {"old": [1, 2], "new": [3], "older": 0}
+    ks.set_many({"small": "x", "large": "x"*10000, "bytes": b"\x00\x01"})
+    assert ks.get_many(["small", "large", "bytes"]) == \
+           {"small": "x", "large": "x"*10000, "bytes": b"\x00\x01"}
+    assert len(ks.execute("select value from data where key = 'large'").fetchone()[0]) < 1000
+
+
+def test_mapping(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("mapping.sqlite")
+    ks.update({"ab": 1, "abc": 2, "b": 3}, c=4)
+    assert len(ks) == 4 and "abc" in ks and "x" not in ks
+    assert list(ks) == ["ab", "abc", "b", "c"]
+    assert list(ks.values()) == [1, 2, 3, 4]
+    assert list(ks.scan_prefix("ab")) == [("ab", 1), ("abc", 2)]
+    assert list(ks.scan_range("abc", "c")) == [("abc", 2), ("b", 3)]
+    del ks["ab"]
+    assert ks.pop("b") == 3
+    assert dict(ks.items()) == {"abc": 2, "c": 4}
+    try:
+        del ks["ab"]
+        assert False
+    except KeyError:
+        pass
+    ks.clear()
+    assert len(ks) == 0
+
+
+def test_transaction(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("tx.sqlite")
+    try:
+        with ks.transaction():
+            ks["a"] = 1
+            ks["b"] = 2
+            raise ValueError()
+    except ValueError:
+        pass
+    assert len(ks) == 0
+    with ks.transaction():
+        ks["a"] = 1
+        ks.set_many({"b": 2})
+    ks.close_if_open()
+    assert ks.get_many(["a", "b"]) == {"a": 1, "b": 2}
+
+
+def test_read_only(tmpdir):
+    os.chdir(str(tmpdir))
+    conn = sqlite3.connect("legacy.sqlite")
+    conn.execute("create table data (key string not null primary key, value text)")
+    conn.execute("insert into data values (?, ?)", ("old", pickle.dumps(1)))
+    conn.commit()
+    conn.close()
+    for kwargs in ({"flag_read_only": True}, {"flag_immutable": True, "flag_shared_cache": True}):
+        ks = f312.Keystore("legacy.sqlite", **kwargs)
+        assert ks["old"] == 1 and dict(ks.items()) == {"old": 1}
+        try:
+            ks["new"] = 2
+            assert False
+        except RuntimeError:
+            pass
+    try:
+        f312.Keystore("missing.sqlite", flag_read_only=True)
+        assert False
+    except RuntimeError:
+        pass
+    assert not os.path.exists("missing.sqlite")
+
+
+def test_ttl(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("ttl.sqlite")
+    ks["old"] = 1
+    try:
+        ks.set("a", 1, ttl=10)
+        assert False
+    except RuntimeError:
+        pass
+    ks.close_if_open()
+
+    ks = f312.Keystore("ttl.sqlite", flag_ttl=True, cache_entries=10)
+    ks.set("short", 2, ttl=0.05)
+    ks.set_many({"long0": 3, "long1": 4}, ttl=3600)
+    assert ks["short"] == 2 and len(ks) == 4
+    time.sleep(0.1)
+    assert "short" not in ks and ks.get("short") is None and list(ks) == ["long0", "long1", "old"]
+    assert ks.get_many(["short", "long0"]) == {"long0": 3}
+    ks.close_if_open()
+
+    # Expiry honoured without flag_ttl once the column exists
+    ks = f312.Keystore("ttl.sqlite", flag_write_behind=True)
+    assert ks.flag_ttl and "short" not in ks
+    ks.set("pending", 5, ttl=0.05)
+    time.sleep(0.1)
+    assert "pending" not in ks
+    ks.commit()
+    assert ks.purge_expired(batch_size=1) == 2
+    assert ks.execute("select count(*) from data").fetchone()[0] == 3
+    ks.close_if_open()
+
+
+def test_in_memory(tmpdir):
+    os.chdir(str(tmpdir))
+
+    def read_file():
+        conn = sqlite3.connect("mem.sqlite")
+        try:
+            return {row[0]: pickle.loads(row[1]) for row in conn.execute("select key, value "
+                                                                         "from data")}
+        finally:
+            conn.close()
+
+    ks = f312.Keystore("mem.sqlite", pragma_profile="fast-wal")
+    ks["a"] = 1
+    ks.close_if_open()
+
+    ks = f312.Keystore("mem.sqlite", flag_in_memory=True, snapshot_writes=3)
+    assert ks["a"] == 1
+    ks["b"] = 2
+    ks["c"] = 3
+    assert read_file() == {"a": 1}
+    ks["d"] = 4
+    assert read_file() == {"a": 1, "b": 2, "c": 3, "d": 4}
+    ks["e"] = 5
+    ks.close_if_open()
+    assert read_file() == {"a": 1, "b": 2, "c": 3, "d": 4, "e": 5}
+
+    ks = f312.Keystore("mem.sqlite", flag_in_memory=True, snapshot_interval=0.05)
+    ks["f"] = 6
+    time.sleep(0.3)
+    assert read_file()["f"] == 6
+    ks.close_if_open()
+
+    ks = f312.Keystore("new.sqlite", flag_in_memory=True, flag_thread_local=True)
+    assert os.path.isfile("new.sqlite")
+    ks["x"] = 1
+    with ks.read_conn() as conn:
+        assert conn.execute("select count(*) from data").fetchone()[0] == 1
+    ks.close_if_open()
+    assert f312.Keystore("new.sqlite")["x"] == 1
+
+
+def test_layout(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("v2.sqlite")
+    ks["0012"] = 1
+    assert ks.layout == 2 and list(ks) == ["0012"]
+    assert "data_key" not in [row[0] for row in ks.execute("select name from sqlite_master")]
+    ks.close_if_open()
+
+    ks = f312.Keystore("v1.sqlite", layout=1, flag_ttl=True)
+    ks.set_many({"0012": 1, "a": [2]})
+    ks.set("b", 3, ttl=3600)
+    assert ks.layout == 1 and list(ks) == [12, "a", "b"]
+    ks.close_if_open()
+    assert f312.migrate_keystore("v1.sqlite", "copy.sqlite") == 3
+    f312.migrate_keystore("v1.sqlite")
+    for filename in ("v1.sqlite", "copy.sqlite"):
+        ks = f312.Keystore(filename)
+        assert ks.layout == 2 and ks.flag_ttl and dict(ks.items()) == {"12": 1, "a": [2], "b": 3}
+        ks.close_if_open()
+
+
+def test_open_value(tmpdir):
+    os.chdir(str(tmpdir))
+    for layout, cache_entries in ((1, 0), (2, 0), (1, 10), (2, 10)):
+        ks = f312.Keystore("stream{}-{}.sqlite".format(layout, cache_entries), layout=layout,
+                           cache_entries=cache_entries)
+        ks.value_chunk_size = 100
+        ks["small"] = b"abc"
+        data = bytes(range(256))*4
+        with ks.open_value("big", "wb") as f:
+            for i in range(0, len(data), 77):
+                f.write(data[i:i+77])
+        with ks.open_value("big") as f:
+            assert f.read(10) == data[:10] and f.read() == data[10:]
+        assert ks["big"] == data and ks.open_value("small").read() == b"abc"
+        assert ks.get_many(["big"]) == {"big": data}
+        if cache_entries:
+            # Streamed values are not cached
+            assert ks.get_cache_stats()["entries"] == 0
+        assert ks.execute("select count(*) from value_chunks").fetchone()[0] == 11
+        try:
+            with ks.open_value("big", "wb") as f:
+                f.write(b"x"*1000)
+                raise ZeroDivisionError()
+        except ZeroDivisionError:
+            pass
+        assert ks["big"] == data
+        # Chunks of replaced/deleted values are removed
+        ks["big"] = 1
+        assert ks.execute("select count(*) from value_chunks").fetchone()[0] == 0
+        with ks.open_value("big", "wb") as f:
+            f.write(b"y"*250)
+        del ks["big"]
+        assert ks.execute("select count(*) from value_chunks").fetchone()[0] == 0
+        ks.close_if_open()
+
+
+def test_migrate_chunked_value(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore("v1.sqlite", layout=1)
+    ks.value_chunk_size = 10
+    ks["small"] = 1
+    with ks.open_value("big", "wb") as f:
+        f.write(b"0123456789"*5)
+    ks.close_if_open()
+    f312.migrate_keystore("v1.sqlite")
+    ks = f312.Keystore("v1.sqlite")
+    assert ks.layout == 2 and ks["big"] == b"0123456789"*5 and ks["small"] == 1
+    # Triggers came along too
+    del ks["big"]
+    assert ks.execute("select count(*) from value_chunks").fetchone()[0] == 0
+    ks.close_if_open()
+
+
+def _contention_worker(worker_id):
+    ks = f312.Keystore("contention.sqlite", busy_timeout=10, max_retries=50)
+    for i in range(30):
+        ks["{}-{}".format(worker_id, i)] = i
+    ks.close_if_open()
+    return ks.get_lock_stats()
+
+
+def test_multiprocess_contention(tmpdir):
+    os.chdir(str(tmpdir))
+    f312.Keystore("contention.sqlite").close_if_open()
+    with multiprocessing.Pool(3) as pool:
+        stats = pool.map(_contention_worker, range(3))
+    # Contention itself depends on scheduling; what matters is that no write was given up
+    assert all(st["failures"] == 0 for st in stats)
+    ks = f312.Keystore("contention.sqlite")
+    assert len(ks) == 90
+    assert ks.get_lock_stats() == {"lock_errors": 0, "retries": 0, "failures": 0, "wait_time": 0.}
+
+
+def _open_ttl_worker(i):
+    for j in range(10):
+        f312.Keystore("ttl{}.sqlite".format(j), flag_ttl=True, max_retries=50).close_if_open()
+
+
+def test_multiprocess_open_ttl(tmpdir):
+    os.chdir(str(tmpdir))
+    for j in range(10):
+        f312.Keystore("ttl{}.sqlite".format(j)).close_if_open()
+    # Processes adding the "expires" column at the same time must not add it twice
+    with multiprocessing.Pool(6) as pool:
+        pool.map(_open_ttl_worker, range(6))
+    for j in range(10):
+        assert "expires" in f312.Keystore("ttl{}.sqlite".format(j)).get_column_names("data")
@@ -0,0 +1,88 @@
+import os
+import f312
+
+
+def test_mapping(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore2("log.ks2")
+    ks["a"] = 1
+    ks.set_many({"b": [2], "c": b"3", "ab": None})
+    del ks["c"]
+    assert ks["a"] == 1 and ks.get("c") is None and "c" not in ks and len(ks) == 3
+    assert list(ks) == ["a", "ab", "b"] and list(ks.scan_prefix("a")) == [("a", 1), ("ab", None)]
+    assert ks.get_many(["b", "c"]) == {"b": [2]} and ks.delete_many(["b", "c"]) == 1
+    try:
+        ks[1] = 1
+        assert False
+    except TypeError:
+        pass
+    ks.close_if_open()
+
+    # From hint file, then by scanning the log
+    for flag_remove_hint in (False, True):
+        if flag_remove_hint:
+            os.remove("log.ks2.hint")
+        ks = f312.Keystore2("log.ks2")
+        assert dict(ks.items()) == {"a": 1, "ab": None}
+        ks.close_if_open()
+
+
+def test_truncated_tail(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore2("log.ks2")
+    ks["a"] = 1
+    ks.commit()
+    size = os.path.getsize("log.ks2")
+    ks["b"] = "x"*100
+    ks.commit()
+    with open("log.ks2", "r+b") as file:
+        file.truncate(os.path.getsize("log.ks2")-10)
+    ks = f312.Keystore2("log.ks2")
+    assert dict(ks.items()) == {"a": 1} and os.path.getsize("log.ks2") == size
+    ks["c"] = 3
+    assert ks["c"] == 3
+    ks.close_if_open()
+
+
+def test_stale_hint(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore2("log.ks2")
+    ks.set_many({"a": 1, "b": "x"*100})
+    ks.close_if_open()
+    # Hint no longer matches the log: must not be reused once the log grows past its size
+    with open("log.ks2", "r+b") as file:
+        file.truncate(os.path.getsize("log.ks2")-10)
+    ks = f312.Keystore2("log.ks2")
+    ks["c"] = "y"*200
+    ks.commit()
+    # Reopens without closing (as after a crash)
+    ks = f312.Keystore2("log.ks2")
+    assert dict(ks.items()) == {"a": 1, "c": "y"*200}
+    ks.close_if_open()
+
+
+def test_compaction(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.Keystore2("log.ks2", compact_ratio=None)
+    for i in range(20):
+        ks.set_many({"key{:03d}".format(j): (i, j) for j in range(100)})
+    ks.delete_many(["key{:03d}".format(j) for j in range(50)])
+    size = ks.get_stats()["file_bytes"]
+    thread = ks.compact(flag_wait=False)
+    ks["late"] = "late"
+    del ks["key099"]
+    thread.join()
+    assert ks.get_stats()["file_bytes"] < size/10
+    expected = {"key{:03d}".format(j): (19, j) for j in range(50, 99)}
+    expected["late"] = "late"
+    assert dict(ks.items()) == expected
+    ks.close_if_open()
+    os.remove("log.ks2.hint")
+    assert dict(f312.Keystore2("log.ks2").items()) == expected
+
+    # Automatic
+    ks = f312.Keystore2("auto.ks2", compact_min_bytes=0, flag_background_compaction=False)
+    for i in range(100):
+        ks["a"] = "x"*100
+    assert ks.get_stats()["dead_bytes"] <= ks.get_stats()["file_bytes"]/2
+    ks.close_if_open()
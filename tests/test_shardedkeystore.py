@@ -0,0 +1,17 @@
+import os
+import f312
+
+
+def test_ShardedKeystore(tmpdir):
+    os.chdir(str(tmpdir))
+    ks = f312.ShardedKeystore("sharded.sqlite", num_shards=3)
+    assert len(ks.get_shard_filenames()) == 3
+    ks["a"] = 1
+    ks.set_many({"k{}".format(i): i for i in range(20)})
+    assert ks["a"] == 1 and len(ks) == 21
+    assert ks.get_many(["k0", "k19", "x"]) == {"k0": 0, "k19": 19}
+    assert [key for key, _ in ks.scan_prefix("k1")] == ["k1"]+["k1{}".format(i) for i in range(10)]
+    assert ks.delete_many(["k0", "x"]) == 1
+    assert ks.bulk_load({"b{}".format(i): i for i in range(50)}, max_workers=2) == 50
+    ks2 = f312.ShardedKeystore("sharded.sqlite", num_shards=3)
+    assert ks2["b49"] == 49 and len(ks2) == 70
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Per-statement overhead of FileSQLiteDB.execute() compared to sqlite3.Connection.execute()."""
+
+import os
+import sys
+import tempfile
+import time
+import f312
+
+
+class _DB(f312.FileSQLiteDB):
+    def _create_schema(self, cursor):
+        cursor.execute("create table t (x integer primary key, y text)")
+
+
+def _timeit(title, n, f):
+    t = time.perf_counter()
+    for _ in range(n):
+        f()
+    elapsed = time.perf_counter()-t
+    print("{:<36} {:>8.2f} us/statement".format(title, elapsed/n*1e6))
+
+
+def main(n):
+    with tempfile.TemporaryDirectory() as dirname:
+        db = _DB(os.path.join(dirname, "overhead.sqlite"))
+        db.execute("insert into t values (1, 'a')")
+        db.commit()
+        conn = db.get_conn()
+        sql = "select y from t where x = ?"
+        _timeit("sqlite3.Connection.execute()", n, lambda: conn.execute(sql, (1,)).fetchone())
+        _timeit("FileSQLiteDB.execute()", n, lambda: db.execute(sql, (1,)).fetchone())
+        db.close_if_open()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Keys per second of Keystore (SQLite) versus Keystore2 (append-only log) on the same workload.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import f312
+
+
+def _timeit(title, n, f):
+    t = time.perf_counter()
+    f()
+    elapsed = time.perf_counter()-t
+    print("{:<40} {:>12.0f} keys/s".format(title, n/elapsed))
+
+
+def _run(title, factory, items):
+    n = len(items)
+    print(title)
+    ks = factory()
+    def set_each():
+        for key, value in items.items():
+            ks[key] = value
+        ks.commit()
+    _timeit("  __setitem__ + commit()", n, set_each)
+    _timeit("  overwrite with set_many() + commit()", n,
+            lambda: (ks.set_many(items), ks.commit()))
+    _timeit("  __getitem__", n, lambda: [ks[key] for key in items])
+    _timeit("  get_many()", n, lambda: ks.get_many(items))
+    ks.close_if_open()
+    _timeit("  reopen", n, lambda: factory().close_if_open())
+
+
+def main(n):
+    items = {"key{:08d}".format(i): {"i": i, "s": "x"*32} for i in range(n)}
+    with tempfile.TemporaryDirectory() as dirname:
+        # Keystore without auto commit, so that both backends commit once per phase
+        _run("Keystore", lambda: f312.Keystore(os.path.join(dirname, "store.sqlite"),
+                                               flag_auto_commit=False), items)
+        _run("Keystore2", lambda: f312.Keystore2(os.path.join(dirname, "store.ks2")), items)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Keys per second of Keystore per-item access versus the batch API."""
+
+import os
+import sys
+import tempfile
+import time
+import f312
+
+
+def _timeit(title, n, f):
+    t = time.perf_counter()
+    f()
+    elapsed = time.perf_counter()-t
+    print("{:<32} {:>12.0f} keys/s".format(title, n/elapsed))
+
+
+def main(n):
+    items = {"key{:08d}".format(i): {"i": i, "s": "x"*32} for i in range(n)}
+    with tempfile.TemporaryDirectory() as dirname:
+        ks = f312.Keystore(os.path.join(dirname, "per-item.sqlite"))
+        def set_each():
+            for key, value in items.items():
+                ks[key] = value
+        _timeit("__setitem__ (auto commit)", n, set_each)
+        _timeit("__getitem__", n, lambda: [ks[key] for key in items])
+        ks.close_if_open()
+
+        ks = f312.Keystore(os.path.join(dirname, "batch.sqlite"))
+        _timeit("set_many()", n, lambda: ks.set_many(items))
+        _timeit("get_many()", n, lambda: ks.get_many(items))
+        _timeit("delete_many()", n, lambda: ks.delete_many(items))
+        ks.close_if_open()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Write throughput and file size of Keystore layout 1 (legacy) versus layout 2."""
+
+import os
+import sys
+import tempfile
+import time
+import f312
+
+
+def main(n, batch_size=1000):
+    items = [("key{:08d}".format(i), {"i": i, "s": "x"*32}) for i in range(n)]
+    with tempfile.TemporaryDirectory() as dirname:
+        for layout in (1, 2):
+            filename = os.path.join(dirname, "layout{}.sqlite".format(layout))
+            ks = f312.Keystore(filename, layout=layout)
+            t = time.perf_counter()
+            for i in range(0, n, batch_size):
+                ks.set_many(items[i:i+batch_size])
+            elapsed = time.perf_counter()-t
+            t = time.perf_counter()
+            for key, _ in items[::10]:
+                ks[key]
+            elapsed_get = time.perf_counter()-t
+            ks.close_if_open()
+            print("layout {}: {:>10.0f} keys/s set_many(), {:>10.0f} keys/s __getitem__, "
+                  "{:>8.1f} KiB".format(layout, n/elapsed, (n//10)/elapsed_get,
+                                        os.path.getsize(filename)/1024))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
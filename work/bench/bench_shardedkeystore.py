@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Keys per second of Keystore.set_many() versus ShardedKeystore.bulk_load()."""
+
+import os
+import sys
+import tempfile
+import time
+import f312
+
+
+def main(n, num_shards):
+    items = {"key{:08d}".format(i): {"i": i, "s": "x"*200} for i in range(n)}
+    with tempfile.TemporaryDirectory() as dirname:
+        ks = f312.Keystore(os.path.join(dirname, "single.sqlite"))
+        t = time.perf_counter()
+        ks.set_many(items)
+        print("{:<40} {:>12.0f} keys/s".format("Keystore.set_many()", n/(time.perf_counter()-t)))
+
+        ks = f312.ShardedKeystore(os.path.join(dirname, "sharded.sqlite"), num_shards)
+        t = time.perf_counter()
+        ks.bulk_load(items)
+        print("{:<40} {:>12.0f} keys/s".format("ShardedKeystore.bulk_load() ({} shards)".
+                                               format(num_shards), n/(time.perf_counter()-t)))
+        t = time.perf_counter()
+        ks.get_many(items)
+        print("{:<40} {:>12.0f} keys/s".format("ShardedKeystore.get_many()",
+                                               n/(time.perf_counter()-t)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Several processes writing to the same Keystore file: throughput and error rate per number of
+workers.
+
+Usage: stress_keystore_contention.py [-h] [--keys KEYS] [--workers 1,2,4,8] ...
+"""
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+import f312
+
+
+def _worker(filename, worker_id, num_keys, kwargs):
+    try:
+        ks = f312.Keystore(filename, **kwargs)
+    except sqlite3.OperationalError:
+        return 0, num_keys, {"retries": 0, "wait_time": 0.}
+    num_ok, num_errors = 0, 0
+    for i in range(num_keys):
+        try:
+            ks["w{}-{}".format(worker_id, i)] = {"i": i, "s": "x"*100}
+            num_ok += 1
+        except sqlite3.OperationalError:
+            num_errors += 1
+    ks.close_if_open()
+    return num_ok, num_errors, ks.get_lock_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--keys", type=int, default=500, help="keys written by each worker")
+    parser.add_argument("--workers", default="1,2,4,8", help="comma-separated numbers of workers")
+    parser.add_argument("--busy-timeout", type=int, default=50, help="busy timeout (ms)")
+    parser.add_argument("--max-retries", type=int, default=10)
+    parser.add_argument("--profile", default=None, help="PRAGMA profile, e.g. fast-wal")
+    args = parser.parse_args()
+    kwargs = {"busy_timeout": args.busy_timeout, "max_retries": args.max_retries,
+              "pragma_profile": args.profile}
+
+    print("{:>7} {:>12} {:>10} {:>10} {:>10}".format("workers", "writes/s", "error %", "retries",
+                                                      "wait (s)"))
+    for num_workers in map(int, args.workers.split(",")):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = os.path.join(dirname, "stress.sqlite")
+            f312.Keystore(filename, pragma_profile=args.profile).close_if_open()
+            t = time.perf_counter()
+            with multiprocessing.Pool(num_workers) as pool:
+                results = pool.starmap(_worker, [(filename, i, args.keys, kwargs)
+                                                 for i in range(num_workers)])
+            elapsed = time.perf_counter()-t
+        num_ok = sum(r[0] for r in results)
+        num_errors = sum(r[1] for r in results)
+        print("{:>7} {:>12.0f} {:>10.2f} {:>10} {:>10.2f}".format(
+              num_workers, num_ok/elapsed, 100.*num_errors/(num_ok+num_errors),
+              sum(r[2]["retries"] for r in results), sum(r[2]["wait_time"] for r in results)))
+
+
+if __name__ == "__main__":
+    main()